@@ -1,8 +1,12 @@
 import aerospike
+from aerospike import exception
 import os
 import time
 import random
 import string
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
 
 config = {'hosts': [(os.environ.get('AEROSPIKE_HOST', '127.0.01'), 3000)],
           'policies': { 'key': aerospike.POLICY_KEY_SEND }
@@ -13,7 +17,7 @@ mpolicy_create = { 'map_write_mode': aerospike.MAP_CREATE_ONLY }
 client = aerospike.client(config).connect()
 
 def create_event(event, available):
-  client.put(("test", "events", for_event), {'name': event, 'available': available})
+  client.put(("test", "events", event), {'name': event, 'available': available})
 
 def create_user(user):
   client.put(("test", "users", user), {'username': user})
@@ -72,7 +76,7 @@ print record
 
 # Part Two - Check availability
 def check_availability_and_purchase(user, event, qty):
-  (key, meta, record) = client.get(("test","events", for_event))
+  (key, meta, record) = client.get(("test","events", event))
   if record['available'] >= qty:
     operations = [
       {
@@ -87,6 +91,8 @@ def check_availability_and_purchase(user, event, qty):
       }
     ]
     client.operate(key, operations, meta, wpolicy)
+    return True
+  return False
 
 # Check availability before purchasing
 # No purchase, not enough stock
@@ -277,7 +283,7 @@ def post_purchases(event):
         'index' : 0
       }
     ]
-    (key, record, meta) = client.operate(key, operations, meta, wpolicy)
+    (key, meta, _) = client.operate(key, operations, meta, wpolicy)
 
 # Post purchases and query results
 create_user(requestor)
@@ -289,3 +295,467 @@ post_purchases(for_event)
 print record
 (key, meta, record) = client.get(("test", "users", requestor))
 print record
+
+# Part Six - Purchase without a prior read
+# The decrement and the order are applied in one atomic operation, without a
+# generation check, so concurrent buyers never conflict. If the decrement took
+# the stock below zero, the purchase is compensated, so an event is never
+# oversold.
+def purchase_from(key, user, qty):
+  order_id = generate_order_id()
+  operations = [
+    {
+      'op' : aerospike.OPERATOR_INCR,
+      'bin': "available",
+      'val': qty * -1
+    },
+    {
+      'op' : aerospike.OP_MAP_PUT,
+      'bin' : "orders",
+      'key': order_id,
+      'val' : {'who': user, 'qty': qty},
+      'map_policy': mpolicy_create
+    },
+    {
+      'op' : aerospike.OPERATOR_READ,
+      'bin': "available"
+    }
+  ]
+  (key, meta, record) = client.operate(key, operations)
+  if record['available'] < 0:
+    # Not enough stock, so give it back and remove the order. Until this is
+    # applied, a concurrent buyer can also see a negative value and be turned
+    # away even though the stock they asked for is available.
+    operations = [
+      {
+        'op' : aerospike.OPERATOR_INCR,
+        'bin': "available",
+        'val': qty
+      },
+      {
+        'op' : aerospike.OP_MAP_REMOVE_BY_KEY,
+        'bin' : "orders",
+        'key': order_id,
+        'return_type': aerospike.MAP_RETURN_NONE
+      }
+    ]
+    client.operate(key, operations)
+    return False
+  return True
+
+def lockfree_purchase(user, event, qty):
+  return purchase_from(("test", "events", event), user, qty)
+
+for_event = "Mens 1500m Final"
+create_event(for_event, 10)
+print lockfree_purchase(requestor, for_event, 9)
+print lockfree_purchase(requestor, for_event, 2)
+(key, meta, record) = client.get(("test", "events", for_event))
+print record
+
+# Contention benchmark, every buyer is purchasing from the same hot event
+def buyer(purchase_fn, event, purchases, results):
+  sold = 0
+  failed = 0
+  for i in range(purchases):
+    try:
+      if purchase_fn("Buyer", event, 1):
+        sold += 1
+      else:
+        failed += 1
+    except exception.RecordGenerationError:
+      failed += 1
+  results.append((sold, failed))
+
+def benchmark_purchase(purchase_fn, buyers, purchases, available):
+  event = "Hot Event:" + purchase_fn.__name__ + ":" + str(buyers)
+  create_event(event, available)
+  results = []
+  threads = []
+  for i in range(buyers):
+    threads.append(threading.Thread(target=buyer, args=(purchase_fn, event, purchases, results)))
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  sold = sum([r[0] for r in results])
+  (key, meta, record) = client.select(("test", "events", event), ["available"])
+  print "{:<32} buyers:{:>3} sold:{:>6} failed:{:>6} sold/sec:{:>9.1f} available:{}".format(
+    purchase_fn.__name__, buyers, sold, sum([r[1] for r in results]), sold / elapsed,
+    record['available'])
+
+for buyers in [1, 4, 16, 64]:
+  benchmark_purchase(check_availability_and_purchase, buyers, 200, 1000000)
+  benchmark_purchase(lockfree_purchase, buyers, 200, 1000000)
+# Selling out, the event must finish with no stock and no oversold tickets
+benchmark_purchase(lockfree_purchase, 64, 200, 5000)
+
+# Part Seven - Sharded stock counters
+# The stock for a hot event is split across a number of records, so buyers are
+# spread over several records rather than all writing to the same one. Each
+# buyer is routed to a shard by a hash of their name, and takes stock from the
+# other shards once their shard has sold out.
+def stock_key(event, shard):
+  return ("test", "stock", event + ":" + str(shard))
+
+def create_sharded_event(event, available, shards):
+  client.put(("test", "events", event), {'name': event, 'shards': shards})
+  for shard in range(shards):
+    # Spread any remainder over the first shards
+    shard_available = available / shards + (1 if shard < available % shards else 0)
+    client.put(stock_key(event, shard), {'available': shard_available})
+
+def shard_for(user, shards):
+  return int(hashlib.md5(user).hexdigest(), 16) % shards
+
+def sharded_purchase(user, event, qty, shards):
+  home = shard_for(user, shards)
+  for i in range(shards):
+    if purchase_from(stock_key(event, (home + i) % shards), user, qty):
+      return True
+  return False
+
+def sharded_available(event, shards):
+  keys = [stock_key(event, shard) for shard in range(shards)]
+  # A shard can be negative while a purchase is being compensated
+  return sum([max(0, r['available']) for (_, _, r) in client.select_many(keys, ['available'])])
+
+for_event = "Womens 100m Final"
+create_sharded_event(for_event, 10, 4)
+print sharded_purchase("Fred", for_event, 2, 4)
+print sharded_purchase("Jim", for_event, 2, 4)
+print sharded_purchase("Amy", for_event, 3, 4)
+print "{} available:{}".format(for_event, sharded_available(for_event, 4))
+
+def sharded_buyer(event, shards, purchases, results):
+  sold = 0
+  failed = 0
+  for i in range(purchases):
+    if sharded_purchase("Buyer-" + str(random.randrange(1000000)), event, 1, shards):
+      sold += 1
+    else:
+      failed += 1
+  results.append((sold, failed))
+
+def benchmark_sharded_purchase(shards, buyers, purchases, available):
+  event = "Hot Event:sharded:" + str(shards)
+  create_sharded_event(event, available, shards)
+  results = []
+  threads = []
+  for i in range(buyers):
+    threads.append(threading.Thread(target=sharded_buyer, args=(event, shards, purchases, results)))
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  sold = sum([r[0] for r in results])
+  print "Shards:{:>3} buyers:{:>3} sold:{:>6} failed:{:>6} sold/sec:{:>9.1f} available:{}".format(
+    shards, buyers, sold, sum([r[1] for r in results]), sold / elapsed,
+    sharded_available(event, shards))
+
+for shards in [1, 2, 4, 8, 16]:
+  benchmark_sharded_purchase(shards, 64, 200, 1000000)
+# Selling out, the buyers have to steal from the other shards
+benchmark_sharded_purchase(8, 64, 200, 5000)
+
+# Part Eight - Indexed reservation expiry
+# Reservations are held as user -> [ts, qty], so the map can be searched by
+# value. The expired reservations are then just a value range, [0] to
+# [cutoff_ts], and can be read and removed without looping over every entry.
+mpolicy_reservations = { 'map_write_mode': aerospike.MAP_CREATE_ONLY,
+                         'map_order': aerospike.MAP_KEY_VALUE_ORDERED }
+
+def reserve_indexed(user, event, qty):
+  operations = [
+    {
+      'op' : aerospike.OPERATOR_INCR,
+      'bin': "available",
+      'val': qty * -1
+    },
+    {
+      'op' : aerospike.OP_MAP_PUT,
+      'bin': "reservations",
+      'key': user,
+      'val': [long(time.time()), qty],
+      'map_policy': mpolicy_reservations
+    },
+    {
+      'op' : aerospike.OPERATOR_READ,
+      'bin': "available"
+    }
+  ]
+  (key, meta, record) = client.operate(("test", "events", event), operations)
+  if record['available'] < 0:
+    # Not enough stock, so give it back and remove the reservation
+    operations = [
+      {
+        'op' : aerospike.OPERATOR_INCR,
+        'bin': "available",
+        'val': qty
+      },
+      {
+        'op' : aerospike.OP_MAP_REMOVE_BY_KEY,
+        'bin' : "reservations",
+        'key': user,
+        'return_type': aerospike.MAP_RETURN_NONE
+      }
+    ]
+    client.operate(key, operations)
+    return False
+  return True
+
+def expire_reservation_indexed(key, cutoff_ts):
+  # Returns the number of reservations expired
+  expired_range = [
+    {
+      'op' : aerospike.OP_MAP_GET_BY_VALUE_RANGE,
+      'bin': "reservations",
+      'val': [0],
+      'range': [cutoff_ts],
+      'return_type': aerospike.MAP_RETURN_VALUE
+    }
+  ]
+  while True:
+    (key, meta, record) = client.operate(key, expired_range)
+    expired = record.get('reservations') or []
+    if len(expired) == 0:
+      return 0
+    operations = [
+      {
+        'op' : aerospike.OP_MAP_REMOVE_BY_VALUE_RANGE,
+        'bin': "reservations",
+        'val': [0],
+        'range': [cutoff_ts],
+        'return_type': aerospike.MAP_RETURN_NONE
+      },
+      {
+        'op' : aerospike.OPERATOR_INCR,
+        'bin': "available",
+        'val': sum([qty for (ts, qty) in expired])
+      }
+    ]
+    try:
+      # The generation check ensures that we return the stock for exactly the
+      # reservations that we read
+      client.operate(key, operations, meta, wpolicy)
+      return len(expired)
+    except exception.RecordGenerationError:
+      pass
+
+def create_expired_reservation_indexed(event):
+  client.put(("test", "events", event), {'name': event, 'available': 469})
+  client.map_put_items(("test", "events", event), "reservations",
+                       { 'Fred': [long(time.time()), 5],
+                         'Jim': [long(time.time() - 50), 7],
+                         'Amy': [long(time.time() - 31), 19] },
+                       mpolicy_reservations)
+
+for_event = "Womens Pole Vault"
+create_expired_reservation_indexed(for_event)
+print expire_reservation_indexed(("test", "events", for_event), long(time.time() - 30))
+(key, meta, record) = client.get(("test", "events", for_event))
+print record
+
+# Sweep every event, handing out pages of keys to a pool of threads
+def expire_page(keys, cutoff_ts):
+  return sum([expire_reservation_indexed(key, cutoff_ts) for key in keys])
+
+def sweep_reservations(page_size, workers):
+  cutoff_ts = long(time.time() - 30)
+  pool = ThreadPool(workers)
+  page = []
+  results = []
+  def collect((key, meta, bins)):
+    page.append(key)
+    if len(page) >= page_size:
+      results.append(pool.apply_async(expire_page, (list(page), cutoff_ts)))
+      del page[:]
+  client.scan("test", "events").foreach(collect, options={'nobins': True})
+  if len(page) > 0:
+    results.append(pool.apply_async(expire_page, (list(page), cutoff_ts)))
+  pool.close()
+  pool.join()
+  return sum([r.get() for r in results])
+
+for i in range(500):
+  create_expired_reservation_indexed("Heat " + str(i))
+start = time.time()
+expired = sweep_reservations(50, 8)
+print "Expired:{} in {:.2f}s".format(expired, time.time() - start)
+
+# Part Nine - Asynchronous credit card authorization
+# The reservation is made straight away, and the authorization is handed to a
+# pool of threads. Each result is applied as it arrives, confirming the sale or
+# backing out the reservation, so a slow authorization no longer holds up the
+# caller.
+def complete_reservation(user, event, qty, authorized, pending):
+  # Returns the order id, or None if the reservation was backed out or had
+  # already expired
+  key = ("test", "events", event)
+  reservation = [
+    {
+      'op' : aerospike.OP_MAP_GET_BY_KEY,
+      'bin': "reservations",
+      'key': user,
+      'return_type': aerospike.MAP_RETURN_VALUE
+    }
+  ]
+  order_id = generate_order_id()
+  while True:
+    (key, meta, record) = client.operate(key, reservation)
+    if record.get('reservations') == None:
+      return None
+    operations = [
+      {
+        'op' : aerospike.OP_MAP_REMOVE_BY_KEY,
+        'bin' : "reservations",
+        'key': user,
+        'return_type': aerospike.MAP_RETURN_NONE
+      }
+    ]
+    if authorized:
+      operations.append({
+        'op' : aerospike.OP_LIST_APPEND,
+        'bin' : "sold_to",
+        'val' : { 'who': user, 'qty': qty, 'order': order_id }
+      })
+      if pending:
+        operations.append({
+          'op' : aerospike.OP_LIST_APPEND,
+          'bin' : "pending",
+          'val' : { 'who': user, 'qty': qty, 'order': order_id }
+        })
+    else:
+      operations.append({
+        'op' : aerospike.OPERATOR_INCR,
+        'bin': "available",
+        'val': qty
+      })
+    try:
+      # The generation check ensures the reservation was not expired and its
+      # stock returned since we read it
+      client.operate(key, operations, meta, wpolicy)
+      return order_id if authorized else None
+    except exception.RecordGenerationError:
+      pass
+
+def authorize_reservation(auth, user, event, qty, pending):
+  return complete_reservation(user, event, qty, auth(user), pending)
+
+def reserve_async(pool, user, event, qty, auth=creditcard_auth, pending=False):
+  # Returns an AsyncResult for the order id, or None if there was no stock
+  if reserve_indexed(user, event, qty):
+    return pool.apply_async(authorize_reservation, (auth, user, event, qty, pending))
+  return None
+
+def declining_auth(user):
+  return False
+
+pool = ThreadPool(4)
+for_event = "Womens 200m Final"
+create_event(for_event, 500)
+accepted = reserve_async(pool, "Fred", for_event, 5, pending=True)
+declined = reserve_async(pool, "Jim", for_event, 7, auth=declining_auth)
+print "Accepted:{} declined:{}".format(accepted.get(), declined.get())
+(key, meta, record) = client.get(("test", "events", for_event))
+print record
+pool.close()
+pool.join()
+
+# With a 1 second authorization, throughput scales with the size of the pool
+def benchmark_reserve_async(concurrency, reservations):
+  event = "Async Event:" + str(concurrency)
+  create_event(event, 500)
+  pool = ThreadPool(concurrency)
+  start = time.time()
+  results = [reserve_async(pool, "Buyer-" + str(i), event, 1) for i in range(reservations)]
+  sold = len([r for r in results if r != None and r.get() != None])
+  elapsed = time.time() - start
+  pool.close()
+  pool.join()
+  print "Concurrency:{:>3} sold:{} purchases/sec:{:.1f}".format(concurrency, sold, sold / elapsed)
+
+for concurrency in [1, 5, 20]:
+  benchmark_reserve_async(concurrency, 20)
+
+# Part Ten - Posting purchases in batches
+# A batch of pending purchases is read from the head of the list, the user
+# updates are grouped so each user is written once, and then the batch is
+# removed in a single operation. Purchases are keyed by order id on the user,
+# so if the poster fails before the batch is removed, posting the batch again
+# is harmless.
+def post_purchases_batch(event, batch_size):
+  # Returns the number of purchases posted
+  head = [
+    {
+      'op' : aerospike.OP_LIST_GET_RANGE,
+      'bin' : "pending",
+      'index' : 0,
+      'val' : batch_size
+    }
+  ]
+  while True:
+    (key, meta, record) = client.operate(("test", "events", event), head)
+    pending = record.get('pending') or []
+    if len(pending) == 0:
+      return 0
+    purchases = {}
+    for res in pending:
+      purchases.setdefault(res['who'], {})[res['order']] = {'event': event, 'qty': res['qty']}
+    for (user, orders) in purchases.items():
+      operations = [
+        {
+          'op' : aerospike.OP_MAP_PUT_ITEMS,
+          'bin' : "purchases",
+          'val' : orders
+        }
+      ]
+      client.operate(("test", "users", user), operations)
+    operations = [
+      {
+        'op' : aerospike.OP_LIST_REMOVE_RANGE,
+        'bin' : "pending",
+        'index' : 0,
+        'val' : len(pending)
+      }
+    ]
+    try:
+      # The generation check ensures we only remove the purchases we posted
+      client.operate(key, operations, meta, wpolicy)
+      return len(pending)
+    except exception.RecordGenerationError:
+      # The list changed, so read the head again. Any purchases posted twice
+      # are simply written again with the same order id.
+      pass
+
+def create_pending_purchases(event, purchases, users):
+  client.put(("test", "events", event),
+             { 'name': event,
+               'pending': [{ 'who': "User-" + str(i % users), 'qty': 1, 'order': generate_order_id() + str(i) }
+                           for i in range(purchases)] })
+
+for_event = "Mens Shot Put"
+create_pending_purchases(for_event, 10, 3)
+print post_purchases_batch(for_event, 100)
+(key, meta, record) = client.get(("test", "users", "User-0"))
+print record
+
+def benchmark_post_purchases(batch_size, purchases, users):
+  event = "Posting Event:" + str(batch_size)
+  create_pending_purchases(event, purchases, users)
+  start = time.time()
+  posted = 0
+  while True:
+    batch = post_purchases_batch(event, batch_size)
+    if batch == 0:
+      break
+    posted += batch
+  elapsed = time.time() - start
+  print "Batch size:{:>5} posted:{} purchases/sec:{:.1f}".format(batch_size, posted, posted / elapsed)
+
+for batch_size in [1, 10, 100, 1000]:
+  benchmark_post_purchases(batch_size, 5000, 100)
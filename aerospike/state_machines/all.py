@@ -1,14 +1,18 @@
 import aerospike
+from aerospike import exception
 import os
 import time
 import random
 import string
+import threading
+import uuid
 
 config = { 'hosts': [(os.environ.get("AEROSPIKE_HOST", "127.0.01"), 3000)],
            'policies': { 'key': aerospike.POLICY_KEY_SEND }
 }
 wpolicy = {'gen': aerospike.POLICY_GEN_EQ}
 mpolicy_create = {'map_write_mode': aerospike.MAP_UPDATE}
+mpolicy_queue = {'map_write_mode': aerospike.MAP_UPDATE, 'map_order': aerospike.MAP_KEY_VALUE_ORDERED}
 
 client = aerospike.client(config).connect()
 
@@ -90,32 +94,194 @@ do_entitlement(device_id, service1, token)
 (key, meta, record) = client.get(("test","accounts",device_id))
 print record
 
-def process_todo(queue):
-  (key, meta, record) = client.get(("test", "events", queue))
-  # Take the next todo and create new entries into each workflow
-  todo = record['todo']
+# Per-service entitlement records
+# Each service on a device is held in its own record, so that an update to
+# one service never conflicts with an update to another service on the same device
+def entitlement_key(device, service):
+  return ("test", "entitlements", device + ":" + service)
+
+def provision_service(device, service, token):
+  if token == "":
+    token = generate_token()
+  key = entitlement_key(device, service)
+  try:
+    client.put(key,
+               { 'device': device,
+                 'service': service,
+                 'token': token,
+                 'ts': long(time.time()),
+                 'failed': 0,
+                 'status': "Waiting" },
+               policy={'exists': aerospike.POLICY_EXISTS_CREATE})
+  except exception.RecordExistsError:
+    (key, meta, record) = client.select(key, ['status'])
+    if record['status'] in ["New", "Suspended"]:
+      operations = [
+        {
+          'op' : aerospike.OPERATOR_WRITE,
+          'bin': "token",
+          'val': token
+        },
+        {
+          'op' : aerospike.OPERATOR_WRITE,
+          'bin': "ts",
+          'val': long(time.time())
+        },
+        {
+          'op' : aerospike.OPERATOR_WRITE,
+          'bin': "failed",
+          'val': 0
+        },
+        {
+          'op' : aerospike.OPERATOR_WRITE,
+          'bin': "status",
+          'val': "Waiting"
+        }
+      ]
+      client.operate(key, operations, meta, wpolicy)
+  # Index the service on the device, this only touches a single map key
+  client.map_put(("test", "accounts", device), 'services', service, long(time.time()),
+                 { 'map_write_mode': aerospike.MAP_UPDATE })
+
+def set_service_status(key, status):
+  operations = [
+    {
+      'op' : aerospike.OPERATOR_WRITE,
+      'bin': "status",
+      'val': status
+    },
+    {
+      'op' : aerospike.OPERATOR_WRITE,
+      'bin': "last_logon_ts",
+      'val': long(time.time())
+    }
+  ]
+  client.operate(key, operations)
+
+def entitle_service(device, service, token):
+  key = entitlement_key(device, service)
+  try:
+    (key, meta, service_rec) = client.select(key, ['token', 'status'])
+  except exception.RecordNotFound:
+    return
+  if service_rec['token'] == token:
+    # Valid, so reset the failures and activate, unless the token was changed
+    # since it was read
+    operations = [
+      {
+        'op' : aerospike.OPERATOR_WRITE,
+        'bin': "failed",
+        'val': 0
+      },
+      {
+        'op' : aerospike.OPERATOR_WRITE,
+        'bin': "status",
+        'val': "Active"
+      },
+      {
+        'op' : aerospike.OPERATOR_WRITE,
+        'bin': "last_logon_ts",
+        'val': long(time.time())
+      }
+    ]
+    client.operate(key, operations, meta, wpolicy)
+  elif service_rec['status'] in ["Waiting", "Suspended"]:
+    # Increment the failures and read back the new value in the same atomic
+    # operation, so concurrent attempts are all counted without a generation check
+    operations = [
+      {
+        'op' : aerospike.OPERATOR_INCR,
+        'bin': "failed",
+        'val': 1
+      },
+      {
+        'op' : aerospike.OPERATOR_WRITE,
+        'bin': "last_logon_ts",
+        'val': long(time.time())
+      },
+      {
+        'op' : aerospike.OPERATOR_READ,
+        'bin': "failed"
+      }
+    ]
+    (_, _, record) = client.operate(key, operations)
+    if record['failed'] > 3:
+      # Exceeded limit
+      set_service_status(key, "Suspended")
+  else:
+    # Record the attempt, even if the service is suspended
+    client.put(key, {'last_logon_ts': long(time.time())})
+
+def get_services(device):
+  (key, meta, record) = client.select(("test", "accounts", device), ['services'])
+  keys = [entitlement_key(device, s) for s in record['services']]
+  return [r for (_, _, r) in client.get_many(keys) if r != None]
+
+device_id = "ATV-456"
+provision_service(device_id, service1, token)
+provision_service(device_id, service2, "")
+entitle_service(device_id, service1, token)
+for i in range(4):
+  entitle_service(device_id, service2, token)
+print get_services(device_id)
+
+# Entitlements for different services on the same device run concurrently
+# without any generation conflicts
+def entitle_many(device, service, token, attempts, errors):
+  for i in range(attempts):
+    try:
+      entitle_service(device, service, token)
+    except exception.RecordGenerationError:
+      errors.append(service)
+
+device_id = "ATV-789"
+errors = []
+threads = []
+for i in range(10):
+  provision_service(device_id, "Service-" + str(i), token)
+  threads.append(threading.Thread(target=entitle_many,
+                                  args=(device_id, "Service-" + str(i), token, 100, errors)))
+for t in threads:
+  t.start()
+for t in threads:
+  t.join()
+print "Services:{}, Generation conflicts:{}".format(len(get_services(device_id)), len(errors))
+
+def process_todo(queue, batch_size=1):
+  # Take the next batch of todos and create new entries into each workflow
+  operations = [
+    {
+      'op' : aerospike.OP_LIST_GET_RANGE,
+      'bin': "todo",
+      'index': 0,
+      'val': batch_size
+    }
+  ]
+  (key, meta, record) = client.operate(("test", "events", queue), operations)
+  todo = record['todo'] or []
   if len(todo) > 0:
-    item = todo[0]
-    item['ts'] = 0
+    for item in todo:
+      item['ts'] = 0
     operations = [
       {
-        'op' : aerospike.OP_LIST_POP,
+        'op' : aerospike.OP_LIST_POP_RANGE,
         'bin': "todo",
-        'index': 0
+        'index': 0,
+        'val': len(todo)
       },
       {
-        'op' : aerospike.OP_LIST_APPEND,
+        'op' : aerospike.OP_LIST_APPEND_ITEMS,
         'bin': "entitlement",
-        'val': item
+        'val': todo
       },
       {
-        'op' : aerospike.OP_LIST_APPEND,
+        'op' : aerospike.OP_LIST_APPEND_ITEMS,
         'bin': "devices",
-        'val': item
+        'val': todo
       }
-
     ]
-    (key, meta, record) = client.operate(key, operations, meta, wpolicy)  
+    client.operate(key, operations, meta, wpolicy)
+  return len(todo)
 
 def do_device(item):
 # TODO: Call the device processing
@@ -175,3 +341,328 @@ process_entitlement("new device")
 (key, meta, record) = client.get(("test","accounts",device_id))
 print record
 
+# Drain the todo list with increasing batch sizes. Each call to process_todo
+# is two round trips, however many items it moves.
+def benchmark_todo(batch_size, items):
+  queue = "bench todo:" + str(batch_size)
+  client.put(("test", "events", queue),
+             { 'todo': [{'service': service1, 'device': "ATV-" + str(i), 'token': token } for i in range(items)],
+               'entitlement': [],
+               'devices': [],
+             })
+  calls = 0
+  start = time.time()
+  while process_todo(queue, batch_size) > 0:
+    calls += 1
+  elapsed = time.time() - start
+  print "Batch size:{:>5} items:{} round trips:{:>5} items/sec:{:.1f}".format(
+    batch_size, items, (calls * 2) + 1, items / elapsed)
+
+for batch_size in [1, 10, 100, 1000]:
+  benchmark_todo(batch_size, 2000)
+
+# Work queues
+# A queue is spread across a number of shard records, each holding a map of
+# item id -> [lease, deliveries, item]. Items that are not claimed have a lease
+# of 0, so ranking the map by value returns the items that are ready (or whose
+# lease has expired) first, without reading the whole queue.
+queue_shards = 8
+lease_timeout = 30
+max_deliveries = 5
+
+def queue_key(queue, shard):
+  return ("test", "queues", queue + ":" + str(shard))
+
+def enqueue(queue, item):
+  item_id = str(uuid.uuid4())
+  operations = [
+    {
+      'op' : aerospike.OP_MAP_PUT,
+      'bin': "items",
+      'key': item_id,
+      'val': [0, 0, item],
+      'map_policy': mpolicy_queue
+    }
+  ]
+  client.operate(queue_key(queue, random.randrange(queue_shards)), operations)
+  return item_id
+
+def claim(queue, shard, batch_size):
+  # Returns a list of (id, item, deliveries), or an empty list if nothing is
+  # ready or another worker claimed from the shard first
+  key = queue_key(queue, shard)
+  operations = [
+    {
+      'op' : aerospike.OP_MAP_GET_BY_RANK_RANGE,
+      'bin': "items",
+      'index': 0,
+      'val': batch_size,
+      'return_type': aerospike.MAP_RETURN_KEY_VALUE
+    }
+  ]
+  try:
+    (key, meta, record) = client.operate(key, operations)
+  except exception.RecordNotFound:
+    return []
+  now = long(time.time())
+  claimed = {}
+  for (item_id, (lease, deliveries, item)) in record['items'] or []:
+    # Items that have been delivered too many times are left for the reaper
+    if lease <= now and deliveries < max_deliveries:
+      claimed[item_id] = [now + lease_timeout, deliveries + 1, item]
+  if len(claimed) == 0:
+    return []
+  operations = [
+    {
+      'op' : aerospike.OP_MAP_PUT_ITEMS,
+      'bin': "items",
+      'val': claimed,
+      'map_policy': mpolicy_queue
+    }
+  ]
+  try:
+    client.operate(key, operations, meta, wpolicy)
+  except exception.RecordGenerationError:
+    return []
+  return [(item_id, v[2], v[1]) for (item_id, v) in claimed.items()]
+
+def ack(queue, shard, item_id):
+  operations = [
+    {
+      'op' : aerospike.OP_MAP_REMOVE_BY_KEY,
+      'bin': "items",
+      'key': item_id,
+      'return_type': aerospike.MAP_RETURN_NONE
+    }
+  ]
+  client.operate(queue_key(queue, shard), operations)
+
+def queue_depth(queue):
+  # Items that have been delivered max_deliveries times are not counted, since
+  # claim skips them and only the reaper can remove them
+  keys = [queue_key(queue, shard) for shard in range(queue_shards)]
+  depth = 0
+  for (_, _, record) in client.select_many(keys, ['items']):
+    if record != None and record.get('items') != None:
+      depth += len([v for v in record['items'].values() if v[1] < max_deliveries])
+  return depth
+
+def process_queue(queue, invoke, batch_size):
+  # Try each shard once, starting at a random shard so that workers spread
+  # out. Returns the number of items processed.
+  processed = 0
+  first = random.randrange(queue_shards)
+  for i in range(queue_shards):
+    shard = (first + i) % queue_shards
+    for (item_id, item, deliveries) in claim(queue, shard, batch_size):
+      invoke(item)
+      ack(queue, shard, item_id)
+      processed += 1
+  return processed
+
+def queue_worker(queue, invoke, batch_size, counts):
+  while True:
+    processed = process_queue(queue, invoke, batch_size)
+    counts.append(processed)
+    if processed == 0:
+      # Everything left is claimed by other workers, so back off until their
+      # leases are acknowledged or expire. Items waiting for the reaper do not
+      # keep the worker running
+      if queue_depth(queue) == 0:
+        break
+      time.sleep(0.01)
+
+def do_queued_entitlement(item):
+  entitle_service(item['device'], item['service'], item['token'])
+
+def enqueue_activation(queue, device, service, token):
+  # Fan the activation out into the device and entitlement work queues
+  item = {'service': service, 'device': device, 'token': token }
+  enqueue(queue + ":devices", item)
+  enqueue(queue + ":entitlement", item)
+
+device_id = "ATV-999"
+provision_service(device_id, service1, token)
+enqueue_activation("new device", device_id, service1, token)
+print "Processed devices:{}, entitlements:{}".format(
+  process_queue("new device:devices", do_device, 10),
+  process_queue("new device:entitlement", do_queued_entitlement, 10))
+print get_services(device_id)
+
+# Drain a queue with an increasing number of workers
+def benchmark_queue(workers, items):
+  queue = "bench:" + str(workers)
+  for i in range(items):
+    enqueue(queue, {'service': service1, 'device': "ATV-" + str(i), 'token': token })
+  counts = []
+  threads = []
+  for i in range(workers):
+    threads.append(threading.Thread(target=queue_worker,
+                                    args=(queue, do_device, 10, counts)))
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  print "Workers:{:>3} items:{} processed:{} items/sec:{:.1f}".format(
+    workers, items, sum(counts), sum(counts) / elapsed)
+
+for workers in [1, 2, 4, 8, 16]:
+  benchmark_queue(workers, 2000)
+
+# Lease expiry and re-delivery
+# A worker that dies leaves its items claimed. The reaper puts items whose lease
+# has expired back on the queue, and moves items that have been delivered
+# max_deliveries times to a dead letter record. Each pass reads no more than
+# max_items items per shard, so it stays cheap however large the queue is.
+def dead_letter_key(queue):
+  return ("test", "queues", queue + ":dead")
+
+def reap_shard(queue, shard, max_items):
+  key = queue_key(queue, shard)
+  now = long(time.time())
+  # Items that are ready to claim have a lease of 0 and rank first, so count
+  # them and then read the next max_items items by rank. These are the oldest
+  # leases, so the read stops short of the whole queue however large it is.
+  operations = [
+    {
+      'op' : aerospike.OP_MAP_GET_BY_VALUE_RANGE,
+      'bin': "items",
+      'val': [0],
+      'range': [1],
+      'return_type': aerospike.MAP_RETURN_COUNT
+    }
+  ]
+  try:
+    (key, meta, record) = client.operate(key, operations)
+  except exception.RecordNotFound:
+    return 0
+  operations = [
+    {
+      'op' : aerospike.OP_MAP_GET_BY_RANK_RANGE,
+      'bin': "items",
+      'index': record['items'] or 0,
+      'val': max_items,
+      'return_type': aerospike.MAP_RETURN_KEY_VALUE
+    }
+  ]
+  (key, meta, record) = client.operate(key, operations)
+  requeue = {}
+  dead = {}
+  for (item_id, (lease, deliveries, item)) in record['items'] or []:
+    if lease == 0 or lease > now:
+      # Ready to claim, or still leased to a live worker
+      continue
+    if deliveries >= max_deliveries:
+      dead[item_id] = [now, deliveries, item]
+    else:
+      requeue[item_id] = [0, deliveries, item]
+  if len(dead) > 0:
+    # Written before the items are removed from the queue, so a failure can
+    # only result in the item being dead lettered twice, never lost
+    client.map_put_items(dead_letter_key(queue), "items", dead)
+  operations = []
+  if len(requeue) > 0:
+    operations.append({
+      'op' : aerospike.OP_MAP_PUT_ITEMS,
+      'bin': "items",
+      'val': requeue,
+      'map_policy': mpolicy_queue
+    })
+  if len(dead) > 0:
+    operations.append({
+      'op' : aerospike.OP_MAP_REMOVE_BY_KEY_LIST,
+      'bin': "items",
+      'val': dead.keys(),
+      'return_type': aerospike.MAP_RETURN_NONE
+    })
+  if len(operations) > 0:
+    try:
+      client.operate(key, operations, meta, wpolicy)
+    except exception.RecordGenerationError:
+      # Items were claimed or acknowledged in the meantime, try on the next pass
+      return 0
+  return len(requeue) + len(dead)
+
+def reap_queue(queue, max_items):
+  reaped = 0
+  for shard in range(queue_shards):
+    if reaped >= max_items:
+      break
+    reaped += reap_shard(queue, shard, max_items - reaped)
+  return reaped
+
+# The same applies to the devices and entitlement lists, where process_device
+# and process_entitlement mark an item as taken by setting its ts. Only the
+# first max_items entries are read, since unfinished items stay at the head
+# of the list.
+def reap_list(queue, bin, max_items):
+  operations = [
+    {
+      'op' : aerospike.OP_LIST_GET_RANGE,
+      'bin': bin,
+      'index': 0,
+      'val': max_items
+    }
+  ]
+  (key, meta, record) = client.operate(("test", "events", queue), operations)
+  cutoff_ts = long(time.time()) - lease_timeout
+  operations = []
+  dead = []
+  items = record[bin] or []
+  # Work backwards, so that removing a dead item does not shift the index of
+  # the items still to be checked
+  for i in reversed(range(len(items))):
+    item = items[i]
+    if item['ts'] != 0 and item['ts'] < cutoff_ts:
+      item['deliveries'] = item.get('deliveries', 0) + 1
+      item['ts'] = 0
+      if item['deliveries'] >= max_deliveries:
+        dead.append(item)
+        operations.append({
+          'op' : aerospike.OP_LIST_REMOVE,
+          'bin': bin,
+          'index': i
+        })
+      else:
+        operations.append({
+          'op' : aerospike.OP_LIST_SET,
+          'bin': bin,
+          'index': i,
+          'val': item
+        })
+  reaped = len(operations)
+  if len(dead) > 0:
+    operations.append({
+      'op' : aerospike.OP_LIST_APPEND_ITEMS,
+      'bin': bin + ":dead",
+      'val': dead
+    })
+  if len(operations) > 0:
+    try:
+      client.operate(key, operations, meta, wpolicy)
+    except exception.RecordGenerationError:
+      # The list was changed by a worker in the meantime, try on the next pass
+      return 0
+  return reaped
+
+# Simulate a worker that dies after claiming, by claiming and never acknowledging
+lease_timeout = 1
+enqueue("reaper", {'service': service1, 'device': device_id, 'token': token })
+for i in range(max_deliveries):
+  claimed = []
+  for shard in range(queue_shards):
+    claimed += claim("reaper", shard, 10)
+  time.sleep(lease_timeout + 1)
+  print "Claimed:{}, reaped:{}".format(len(claimed), reap_queue("reaper", 100))
+(key, meta, record) = client.get(dead_letter_key("reaper"))
+print record
+
+create_activation("stuck device", device_id, service1, token)
+process_todo("stuck device")
+client.list_set(("test", "events", "stuck device"), "devices", 0,
+                {'service': service1, 'device': device_id, 'token': token, 'ts': long(time.time() - 60)})
+print "Reaped:{}".format(reap_list("stuck device", "devices", 100))
+(key, meta, record) = client.get(("test", "events", "stuck device"))
+print record
@@ -16,4 +16,7 @@ def clean():
     cleanOneSet("test", "parts")
     cleanOneSet("test", "locations")
     cleanOneSet("test", "xfers")
+    cleanOneSet("test", "entitlements")
+    cleanOneSet("test", "queues")
+    cleanOneSet("test", "stock")
 
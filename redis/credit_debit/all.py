@@ -0,0 +1,155 @@
+from redis import StrictRedis, WatchError
+import os
+import time
+import random
+import string
+import json
+import threading
+
+redis = StrictRedis(host=os.environ.get("REDIS_HOST", "localhost"),
+                    port=os.environ.get("REDIS_PORT", 6379),
+                    db=0)
+redis.flushall()
+
+def create_account(user, opening_balance):
+  p = redis.pipeline()
+  p.delete("ledger:" + user)
+  p.hset("accounts:" + user, "balance", opening_balance)
+  p.execute()
+
+def generate_transaction_id():
+  return ''.join(random.choice(string.ascii_uppercase + string.digits) \
+    for _ in range(6))
+
+# Part One - Debit & Credit with WATCH / MULTI
+def watch_debit_credit(tx_id, from_account, to_account, amount):
+  # Returns (applied, conflicts), retrying the transaction until it is applied or
+  # the funds are not available
+  conflicts = 0
+  p = redis.pipeline()
+  try:
+    while True:
+      try:
+        p.watch("accounts:" + from_account, "txs:" + tx_id)
+        if p.exists("txs:" + tx_id):
+          return (False, conflicts)
+        balance = int(p.hget("accounts:" + from_account, "balance"))
+        if balance < amount:
+          return (False, conflicts)
+        entry = json.dumps({'tx_id': tx_id, 'from': from_account, 'to': to_account,
+                            'amt': amount, 'ts': long(time.time())})
+        p.multi()
+        p.hincrby("accounts:" + from_account, "balance", amount * -1)
+        p.hincrby("accounts:" + to_account, "balance", amount)
+        p.rpush("ledger:" + from_account, entry)
+        p.rpush("ledger:" + to_account, entry)
+        p.hmset("txs:" + tx_id, {'from': from_account, 'to': to_account,
+                                 'amt': amount, 'state': "Credited"})
+        p.execute()
+        return (True, conflicts)
+      except WatchError:
+        conflicts += 1
+  finally:
+    p.reset()
+
+# Part Two - Debit & Credit as a single Lua script
+#   KEYS[1] - accounts:<from>, KEYS[2] - accounts:<to>
+#   KEYS[3] - ledger:<from>,   KEYS[4] - ledger:<to>
+#   KEYS[5] - txs:<tx_id>
+#   ARGV[1] - amount, ARGV[2] - ledger entry
+#   ARGV[3] - from account, ARGV[4] - to account
+# Returns 1 if applied, 0 for insufficient funds and -1 if the transaction
+# has already been applied
+debit_credit_lua = """
+if redis.call('EXISTS', KEYS[5]) == 1 then
+  return -1
+end
+local amount = tonumber(ARGV[1])
+local balance = tonumber(redis.call('HGET', KEYS[1], 'balance') or '0')
+if balance < amount then
+  return 0
+end
+redis.call('HINCRBY', KEYS[1], 'balance', -amount)
+redis.call('HINCRBY', KEYS[2], 'balance', amount)
+redis.call('RPUSH', KEYS[3], ARGV[2])
+redis.call('RPUSH', KEYS[4], ARGV[2])
+redis.call('HMSET', KEYS[5], 'from', ARGV[3], 'to', ARGV[4], 'amt', amount, 'state', 'Credited')
+return 1
+"""
+
+# Registered once, then invoked by EVALSHA (the script is re-loaded if the
+# server has been restarted or flushed)
+debit_credit_script = redis.register_script(debit_credit_lua)
+
+def lua_debit_credit(tx_id, from_account, to_account, amount):
+  entry = json.dumps({'tx_id': tx_id, 'from': from_account, 'to': to_account,
+                      'amt': amount, 'ts': long(time.time())})
+  result = debit_credit_script(keys=["accounts:" + from_account,
+                                     "accounts:" + to_account,
+                                     "ledger:" + from_account,
+                                     "ledger:" + to_account,
+                                     "txs:" + tx_id],
+                               args=[amount, entry, from_account, to_account])
+  return (result == 1, 0)
+
+def print_accounts(accounts):
+  for a in accounts:
+    print "{}: balance:{}, ledger:{}".format(a, redis.hget("accounts:" + a, "balance"),
+                                              redis.llen("ledger:" + a))
+
+# Enough funds
+create_account("Mum", 150)
+create_account("Dad", 0)
+print watch_debit_credit(generate_transaction_id(), "Mum", "Dad", 100)
+# Not enough funds
+print watch_debit_credit(generate_transaction_id(), "Dad", "Mum", 101)
+print_accounts(["Mum", "Dad"])
+
+create_account("Son", 200)
+create_account("Daughter", 0)
+# Enough funds
+my_tx = generate_transaction_id()
+print lua_debit_credit(my_tx, "Son", "Daughter", 10)
+# Replaying the same transaction is a no-op
+print lua_debit_credit(my_tx, "Son", "Daughter", 10)
+# Not enough funds
+print lua_debit_credit(generate_transaction_id(), "Daughter", "Son", 11)
+print_accounts(["Son", "Daughter"])
+print redis.lrange("ledger:Son", 0, -1)
+
+# Part Three - Benchmark WATCH versus Lua under contention
+def benchmark_client(transfer, accounts, transfers, results):
+  applied = 0
+  conflicts = 0
+  for i in range(transfers):
+    (from_account, to_account) = random.sample(accounts, 2)
+    (ok, c) = transfer(generate_transaction_id() + str(i), from_account, to_account, 1)
+    applied += 1 if ok else 0
+    conflicts += c
+  results.append((applied, conflicts))
+
+def benchmark(transfer, clients, transfers_per_client):
+  # A handful of hot accounts, so that every client contends on the same keys
+  accounts = ["bench-" + str(i) for i in range(4)]
+  for a in accounts:
+    create_account(a, 1000000)
+  results = []
+  threads = []
+  for i in range(clients):
+    threads.append(threading.Thread(target=benchmark_client,
+                                    args=(transfer, accounts, transfers_per_client, results)))
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  applied = sum([r[0] for r in results])
+  conflicts = sum([r[1] for r in results])
+  total = sum([int(redis.hget("accounts:" + a, "balance")) for a in accounts])
+  print "{:>6} clients:{:>3} tx/sec:{:>9.1f} applied:{:>6} conflicts:{:>7} total balance:{}".format(
+    transfer.__name__.split("_")[0], clients, applied / elapsed, applied, conflicts, total)
+
+for clients in [1, 2, 4, 8, 16, 32, 64]:
+  benchmark(watch_debit_credit, clients, 200)
+  benchmark(lua_debit_credit, clients, 200)
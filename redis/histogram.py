@@ -0,0 +1,48 @@
+# Sales histograms, shared by the inventory and pub_sub examples
+# A histogram is a set of counters held in a BITFIELD, one bucket per minute,
+# hour or day. Each time window (a day of minutes or hours, or a month of days)
+# has its own key, which expires once it is older than the retention.
+# A histogram is described by a dictionary with the counter type (i.e. width),
+# overflow policy (WRAP, SAT or FAIL), resolution and the number of windows to
+# retain, for example:
+# { 'type': "u32", 'overflow': "SAT", 'resolution': "hour", 'retention': 7 }
+import time
+
+histogram_resolutions = {
+  'minute': { 'buckets': 1440, 'window': "%Y%m%d", 'window_seconds': 86400 },
+  'hour': { 'buckets': 24, 'window': "%Y%m%d", 'window_seconds': 86400 },
+  'day': { 'buckets': 31, 'window': "%Y%m", 'window_seconds': 31 * 86400 }
+}
+
+def histogram_buckets(histogram):
+  return histogram_resolutions[histogram['resolution']]['buckets']
+
+def histogram_key(histogram, name, ts):
+  resolution = histogram_resolutions[histogram['resolution']]
+  return "{}:{}:{}".format(name, histogram['resolution'],
+                           time.strftime(resolution['window'], time.gmtime(ts)))
+
+def histogram_bucket(histogram, ts):
+  t = time.gmtime(ts)
+  if histogram['resolution'] == "minute":
+    return t.tm_hour * 60 + t.tm_min
+  elif histogram['resolution'] == "hour":
+    return t.tm_hour
+  else:
+    return t.tm_mday - 1
+
+def histogram_expiry(histogram, ts):
+  return long(ts) + histogram['retention'] * histogram_resolutions[histogram['resolution']]['window_seconds']
+
+def histogram_incr(p, histogram, name, ts, amount):
+  key = histogram_key(histogram, name, ts)
+  p.execute_command("BITFIELD", key, "OVERFLOW", histogram['overflow'],
+                    "INCRBY", histogram['type'], "#" + str(histogram_bucket(histogram, ts)), amount)
+  p.expireat(key, histogram_expiry(histogram, ts))
+
+def histogram_read(r, histogram, name, ts):
+  # Read every bucket of the window in a single BITFIELD call
+  vals = []
+  for i in range(histogram_buckets(histogram)):
+    vals += ["GET", histogram['type'], "#" + str(i)]
+  return r.execute_command("BITFIELD", histogram_key(histogram, name, ts), *vals)
@@ -1,11 +1,20 @@
-from redis import StrictRedis, WatchError
+from redis import StrictRedis, ResponseError
 import os
 import time
 import random
 import string
 import json
+import hashlib
+import struct
+import threading
+import sys
 from datetime import date
 
+# The histogram and transaction helpers are shared with the other examples
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from histogram import histogram_buckets, histogram_key, histogram_bucket, histogram_expiry, histogram_incr, histogram_read
+from transactions import transaction_stats, optimistic_transaction
+
 redis = StrictRedis(host=os.environ.get("REDIS_HOST", "localhost"), 
                     port=os.environ.get("REDIS_PORT", 6379),
                     db=0)
@@ -23,23 +32,81 @@ def create_event(event_name, available, price):
   p.hsetnx("events:" + event_name, "price", price)
   p.execute()
 
+# Order codecs
+# Orders are written through a codec, so the encoding can be changed without
+# changing the code that creates or posts them. Each codec has an encode and
+# decode function, plus the functions to store and load the encoded value.
+# order_codec is the codec used for the orders lists and purchase_orders keys.
+def encode_hash_order(order):
+  # Short field names keep the hash small enough to use the compact encoding
+  return { 'w': order['who'], 'q': order['qty'], 't': order['ts'], 'c': order['cost'],
+           'o': order['order_id'], 'e': order['event'] }
+
+def decode_hash_order(fields):
+  return { 'who': fields['w'], 'qty': int(fields['q']), 'ts': long(fields['t']),
+           'cost': float(fields['c']), 'order_id': fields['o'], 'event': fields['e'] }
+
+# who, order_id, event, qty, ts, cost
+order_struct = struct.Struct("!16s12s32sHId")
+
+def encode_struct_order(order):
+  for (field, size) in [('who', 16), ('order_id', 12), ('event', 32)]:
+    if len(order[field]) > size:
+      raise ValueError("{} is longer than {} bytes: {}".format(field, size, order[field]))
+  return order_struct.pack(order['who'], order['order_id'], order['event'],
+                           order['qty'], order['ts'], order['cost'])
+
+def decode_struct_order(value):
+  (who, order_id, event, qty, ts, cost) = order_struct.unpack(value)
+  return { 'who': who.rstrip('\0'), 'qty': qty, 'ts': long(ts), 'cost': cost,
+           'order_id': order_id.rstrip('\0'), 'event': event.rstrip('\0') }
+
+def store_string(p, key, value):
+  p.set(key, value)
+
+def store_hash(p, key, value):
+  p.hmset(key, value)
+
+json_codec = { 'name': "json", 'encode': json.dumps, 'decode': json.loads,
+               'store': store_string, 'load': redis.get }
+struct_codec = { 'name': "struct", 'encode': encode_struct_order, 'decode': decode_struct_order,
+                 'store': store_string, 'load': redis.get }
+hash_codec = { 'name': "hash", 'encode': encode_hash_order, 'decode': decode_hash_order,
+               'store': store_hash, 'load': redis.hgetall }
+
+def store_order(p, order, codec):
+  codec['store'](p, "purchase_orders:" + order['order_id'], codec['encode'](order))
+
+def load_order(order_id, codec):
+  return codec['decode'](codec['load']("purchase_orders:" + order_id))
+
+def check_list_codec(codec):
+  # A list element is a single string, so orders pushed onto a list can not be
+  # stored as a hash
+  if codec['store'] != store_string:
+    raise ValueError("{} orders can not be pushed onto a list".format(codec['name']))
+
+def push_order(p, key, order, codec):
+  p.lpush(key, codec['encode'](order))
+
+order_codec = json_codec
+
 def check_availability_and_purchase(user, event_name, qty):
-  p = redis.pipeline()
-  try:
-    redis.watch("events:" + event_name)
-    available = int(redis.hget("events:" + event_name, "available"))
+  check_list_codec(order_codec)
+  def purchase_tickets(p):
+    available = int(p.hget("events:" + event_name, "available"))
     if available >= qty:
       order_id = generate_order_id()
-      price = float(redis.hget("events:" + event_name, "price"))
+      price = float(p.hget("events:" + event_name, "price"))
       purchase = { 'who': user, 'qty': qty, 'ts': long(time.time()), 
-                   'cost': qty * price, 'order_id': order_id }
+                   'cost': qty * price, 'order_id': order_id, 'event': event_name }
+      p.multi()
       p.hincrby("events:" + event_name, "available", qty * -1)
-      p.lpush("orders:" + event_name, json.dumps(purchase))
+      push_order(p, "orders:" + event_name, purchase, order_codec)
       p.execute()
-  except WatchError:
+  (applied, _) = optimistic_transaction(redis, ["events:" + event_name], purchase_tickets)
+  if not applied:
     print "Write Conflict: {}".format("events:" + event_name)
-  finally:
-    p.reset()
 
 # Check availability before purchasing
 requestor = "Fred"
@@ -56,37 +123,61 @@ print redis.lrange("orders:" + for_event, 0, -1)
 print redis.hgetall("events:" + for_event)
 
 # Part Two - Reserve stock & Credit Card auth
-def reserve(user, event_name, qty):
-  p = redis.pipeline()
-  try:
-    redis.watch("events:" + event_name)
-    available = int(redis.hget("events:" + event_name, "available"))
+# The deadlines of the reservations for an event. The hash tag is the name of the
+# events key, so both keys are in the same slot on Redis Cluster
+def reservation_deadlines_key(event_name):
+  return "reservation_deadlines:{events:" + event_name + "}"
+
+def reserve_stock(user, event_name, qty):
+  # Returns (order_id, price) if the tickets were reserved, otherwise None
+  def reserve_tickets(p):
+    available = int(p.hget("events:" + event_name, "available"))
     if available >= qty:
       order_id = generate_order_id()
-      price = float(redis.hget("events:" + event_name, "price"))
+      price = float(p.hget("events:" + event_name, "price"))
+      p.multi()
       p.hincrby("events:" + event_name, "available", qty * -1)
       p.hincrby("events:" + event_name, "reservations", qty)
       p.hsetnx("events:" + event_name, "reservations-user:" + user, qty)
-      p.hsetnx("events:" + event_name, "reservations-ts:" + user, long(time.time()))
+      ts = long(time.time())
+      p.hsetnx("events:" + event_name, "reservations-ts:" + user, ts)
+      p.zadd(reservation_deadlines_key(event_name), { user: ts })
       p.execute()
-  except WatchError:
+      return (order_id, price)
+  (applied, reservation) = optimistic_transaction(redis, ["events:" + event_name], reserve_tickets)
+  if not applied:
     print "Write Conflict: {}".format("events:" + event_name)
-  finally:
-    p.reset()
+  return reservation
+
+def reserve(user, event_name, qty):
+  check_list_codec(order_codec)
+  reservation = reserve_stock(user, event_name, qty)
+  if reservation == None:
+    return
+  (order_id, price) = reservation
   if creditcard_auth(user):
-    try:
-      purchase = { 'who': user, 'qty': qty, 'ts': long(time.time()), 
-                   'cost': qty * price, 'order_id': order_id }
-      redis.watch("events:" + event_name)
-      p.hincrby("events:" + event_name, "reservations", qty * -1)
+    def confirm_tickets(p):
+      # Nothing to confirm if the reservation expired or was backed out while
+      # the card was being authorized, since the stock has already gone back
+      reserved = p.hget("events:" + event_name, "reservations-user:" + user)
+      if reserved == None:
+        return False
+      reserved = int(reserved)
+      purchase = { 'who': user, 'qty': reserved, 'ts': long(time.time()), 
+                   'cost': reserved * price, 'order_id': order_id, 'event': event_name }
+      p.multi()
+      p.hincrby("events:" + event_name, "reservations", reserved * -1)
       p.hdel("events:" + event_name, "reservations-user:" + user)
       p.hdel("events:" + event_name, "reservations-ts:" + user)
-      p.lpush("orders:" + event_name, json.dumps(purchase))
+      p.zrem(reservation_deadlines_key(event_name), user)
+      push_order(p, "orders:" + event_name, purchase, order_codec)
       p.execute()
-    except WatchError:
+      return True
+    (applied, confirmed) = optimistic_transaction(redis, ["events:" + event_name], confirm_tickets)
+    if not applied:
       print "Write Conflict: {}".format("events:" + event_name)
-    finally:
-      p.reset()
+    elif not confirmed:
+      print "Reservation expired on order {} for {}".format(order_id, user)
   else:
     print "Auth failure on order {} for {}".format(order_id, user)
     backout_reservation(user, event_name, qty)
@@ -97,18 +188,23 @@ def creditcard_auth(user):
   return True
 
 def backout_reservation(user, event_name, qty):
-  p = redis.pipeline()
-  try:
-    redis.watch("events:" + event_name)
-    p.hincrby("events:" + event_name, "available", qty)
-    p.hincrby("events:" + event_name, "reservations", qty * -1)
+  def backout_tickets(p):
+    # Nothing to do if the reservation has already been backed out or expired
+    reserved = p.hget("events:" + event_name, "reservations-user:" + user)
+    if reserved == None:
+      return False
+    p.multi()
+    p.hincrby("events:" + event_name, "available", int(reserved))
+    p.hincrby("events:" + event_name, "reservations", int(reserved) * -1)
     p.hdel("events:" + event_name, "reservations-user:" + user)
     p.hdel("events:" + event_name, "reservations-ts:" + user)
+    p.zrem(reservation_deadlines_key(event_name), user)
     p.execute()
-  except:
+    return True
+  (applied, backed_out) = optimistic_transaction(redis, ["events:" + event_name], backout_tickets)
+  if not applied:
     print "Write Conflict: {}".format("events:" + event_name)
-  finally:
-    p.reset()
+  return backed_out == True
 
 # Query results
 for_event = "Womens Marathon Final"
@@ -152,56 +248,56 @@ while True:
   else:
     time.sleep(1)
 
+
 # Part Four - Posting purchases
 def reserve_with_pending(user, event_name, qty):
-  p = redis.pipeline()
-  try:
-    redis.watch("events:" + event_name)
-    available = int(redis.hget("events:" + event_name, "available"))
-    if available >= qty:
-      order_id = generate_order_id()
-      price = float(redis.hget("events:" + event_name, "price"))
-      p.hincrby("events:" + event_name, "available", qty * -1)
-      p.hincrby("events:" + event_name, "reservations", qty)
-      p.hsetnx("events:" + event_name, "reservations-user:" + user, qty)
-      p.hsetnx("events:" + event_name, "reservations-ts:" + user, long(time.time()))
-      p.execute()
-  except WatchError:
-    print "Write Conflict: {}".format("events:" + event_name)
-  finally:
-    p.reset()
+  reservation = reserve_stock(user, event_name, qty)
+  if reservation == None:
+    return
+  (order_id, price) = reservation
   if creditcard_auth(user):
-    try:
-      purchase = { 'who': user, 'qty': qty, 'ts': long(time.time()), 'cost': qty * price, 
+    def confirm_tickets(p):
+      # Nothing to confirm if the reservation expired or was backed out while
+      # the card was being authorized, since the stock has already gone back
+      reserved = p.hget("events:" + event_name, "reservations-user:" + user)
+      if reserved == None:
+        return False
+      reserved = int(reserved)
+      purchase = { 'who': user, 'qty': reserved, 'ts': long(time.time()), 'cost': reserved * price, 
                    'order_id': order_id, 'event': event_name }
-      redis.watch("events:" + event_name)
-      p.hincrby("events:" + event_name, "reservations", qty * -1)
+      p.multi()
+      p.hincrby("events:" + event_name, "reservations", reserved * -1)
       p.hdel("events:" + event_name, "reservations-user:" + user)
       p.hdel("events:" + event_name, "reservations-ts:" + user)
-      p.set("purchase_orders:" + order_id, json.dumps(purchase))
+      p.zrem(reservation_deadlines_key(event_name), user)
+      store_order(p, purchase, order_codec)
       p.lpush("pending:" + event_name, order_id)
       p.execute()
-    except WatchError:
+      return True
+    (applied, confirmed) = optimistic_transaction(redis, ["events:" + event_name], confirm_tickets)
+    if not applied:
       print "Write Conflict: {}".format("events:" + event_name)
-    finally:
-      p.reset()
+    elif not confirmed:
+      print "Reservation expired on order {} for {}".format(order_id, user)
   else:
     print "Auth failure on order {} for {}".format(order_id, user)
     backout_reservation(user, event_name, qty)
 
+# Sales histogram - counter type (i.e. width), overflow policy (WRAP, SAT or
+# FAIL), resolution and the number of windows to retain
+sales_histogram = { 'type': "u32", 'overflow': "SAT", 'resolution': "hour", 'retention': 7 }
+
 def post_purchases(event_name):
   order_id = redis.rpop("pending:" + event_name)
   if order_id != None:
     p = redis.pipeline()
-    order = json.loads(redis.get("purchase_orders:" + order_id))
+    order = load_order(order_id, order_codec)
     p.sadd("invoices:" + order['who'], order_id)
     p.sadd("sales:" + event_name, order_id)
     p.hincrbyfloat("sales_summary", event_name + ":total_sales", order['cost'])
     p.hincrby("sales_summary", event_name + ":total_tickets_sold", order['qty'])
-    hour_of_day = int(time.strftime("%H"))
-    vals = ["INCRBY", "u8", (hour_of_day+1) * 8, order['qty']]
-    p.execute_command("BITFIELD", "sales_histogram:time_of_day", *vals)
-    p.execute_command("BITFIELD", "sales_histogram:time_of_day:" + event_name, *vals)
+    histogram_incr(p, sales_histogram, "sales_histogram", order['ts'], order['qty'])
+    histogram_incr(p, sales_histogram, "sales_histogram:" + event_name, order['ts'], order['qty'])
     p.execute()
 
 # Post purchases and query results
@@ -227,15 +323,487 @@ for next_event in events:
 
 print "=== Orders"
 for i in redis.scan_iter(match="purchase_orders:*"):
-  print redis.get(i)  
+  print load_order(i[len("purchase_orders:"):], order_codec)
 
 print "=== Sales Summary \n{}".format(redis.hgetall("sales_summary"))
 
 print "=== Sales Summary - hour of sale histogram"
-hist = redis.get("sales_histogram:time_of_day")
-for i in range(0, 24):
-  vals = ["GET", "u8", (i+1) * 8]
-  total_sales = int(redis.execute_command("BITFIELD", "sales_histogram:time_of_day", *vals)[0])
-  print " {} = {}".format(i, total_sales)
+hist = histogram_read(redis, sales_histogram, "sales_histogram", time.time())
+for i in range(histogram_buckets(sales_histogram)):
+  print " {} = {}".format(i, hist[i])
+
+
+
+# Part Five - Sharded stock counters
+# The stock for a hot event is split across a number of keys. The hash tag
+# ({...}) keeps the stock and orders for a shard in the same slot, so that the
+# script below can run on Redis Cluster, while the shards themselves are spread
+# across the cluster.
+def stock_key(event_name, shard):
+  return "stock:{" + event_name + ":" + str(shard) + "}"
+
+def shard_orders_key(event_name, shard):
+  return "orders:{" + event_name + ":" + str(shard) + "}"
+
+def create_sharded_event(event_name, available, price, shards):
+  p = redis.pipeline()
+  p.hsetnx("events:" + event_name, "capacity", available)
+  p.hsetnx("events:" + event_name, "price", price)
+  p.hsetnx("events:" + event_name, "shards", shards)
+  for shard in range(shards):
+    # Spread any remainder over the first shards
+    p.set(stock_key(event_name, shard), available / shards + (1 if shard < available % shards else 0))
+  p.execute()
+
+# KEYS[1] - stock key, KEYS[2] - orders key, ARGV[1] - qty, ARGV[2] - order
+# Returns the remaining stock, or -1 if there was not enough stock
+shard_purchase_lua = """
+local qty = tonumber(ARGV[1])
+local available = tonumber(redis.call('GET', KEYS[1]) or '0')
+if available < qty then
+  return -1
+end
+redis.call('LPUSH', KEYS[2], ARGV[2])
+return redis.call('DECRBY', KEYS[1], qty)
+"""
+shard_purchase_script = redis.register_script(shard_purchase_lua)
+
+def shard_for(user, shards):
+  return int(hashlib.md5(user).hexdigest(), 16) % shards
+
+def sharded_purchase(user, event_name, qty, price, shards):
+  # Try the buyers own shard first, then take stock from the other shards
+  check_list_codec(order_codec)
+  home = shard_for(user, shards)
+  purchase = order_codec['encode']({ 'who': user, 'qty': qty, 'ts': long(time.time()),
+                                     'cost': qty * price, 'order_id': generate_order_id(),
+                                     'event': event_name })
+  for i in range(shards):
+    shard = (home + i) % shards
+    if shard_purchase_script(keys=[stock_key(event_name, shard), shard_orders_key(event_name, shard)],
+                             args=[qty, purchase]) >= 0:
+      return True
+  return False
 
+def sharded_available(event_name, shards):
+  p = redis.pipeline(transaction=False)
+  for shard in range(shards):
+    p.get(stock_key(event_name, shard))
+  return sum([int(a) for a in p.execute()])
+
+for_event = "Womens 100m Final"
+create_sharded_event(for_event, 10, 9, 4)
+print sharded_purchase("Fred", for_event, 2, 9, 4)
+print sharded_purchase("Jim", for_event, 2, 9, 4)
+print sharded_purchase("Amy", for_event, 3, 9, 4)
+print "{} available:{}".format(for_event, sharded_available(for_event, 4))
+
+def sharded_buyer(event_name, shards, purchases, results):
+  sold = 0
+  for i in range(purchases):
+    if sharded_purchase("Buyer-" + str(random.randrange(1000000)), event_name, 1, 9, shards):
+      sold += 1
+  results.append(sold)
+
+def benchmark_sharded_purchase(shards, buyers, purchases, available):
+  event_name = "Hot Event:" + str(shards)
+  create_sharded_event(event_name, available, 9, shards)
+  results = []
+  threads = []
+  for i in range(buyers):
+    threads.append(threading.Thread(target=sharded_buyer, args=(event_name, shards, purchases, results)))
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  print "Shards:{:>3} buyers:{:>3} sold:{:>6} sold/sec:{:>9.1f} available:{}".format(
+    shards, buyers, sum(results), sum(results) / elapsed, sharded_available(event_name, shards))
+
+for shards in [1, 2, 4, 8, 16]:
+  benchmark_sharded_purchase(shards, 64, 200, 1000000)
+# Selling out, the buyers have to steal from the other shards
+benchmark_sharded_purchase(8, 64, 200, 5000)
+
+# Part Six - Reservation lifecycle as Lua scripts
+# Each step checks and changes the event in one atomic script, so there is
+# nothing to WATCH and nothing to retry. The scripts are registered once and
+# invoked by their SHA.
+
+# KEYS[1] - events:<event>, KEYS[2] - reservation deadlines of the event
+# ARGV[1] - user, ARGV[2] - qty, ARGV[3] - ts, ARGV[4] - deadline member
+# Returns 1 if reserved, 0 if there is not enough stock and -1 if the user
+# already has a reservation
+reserve_lua = """
+if redis.call('HEXISTS', KEYS[1], 'reservations-user:' .. ARGV[1]) == 1 then
+  return -1
+end
+local qty = tonumber(ARGV[2])
+if tonumber(redis.call('HGET', KEYS[1], 'available') or '0') < qty then
+  return 0
+end
+redis.call('HINCRBY', KEYS[1], 'available', -qty)
+redis.call('HINCRBY', KEYS[1], 'reservations', qty)
+redis.call('HSET', KEYS[1], 'reservations-user:' .. ARGV[1], qty)
+redis.call('HSET', KEYS[1], 'reservations-ts:' .. ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+return 1
+"""
+
+# KEYS[1] - events:<event>, KEYS[2] - orders:<event>,
+# KEYS[3] - purchase_orders:<order_id>, KEYS[4] - pending:<event>,
+# KEYS[5] - reservation deadlines of the event, KEYS[6] - pending_orders stream
+# ARGV[1] - user, ARGV[2] - order_id, ARGV[3] - event, ARGV[4] - ts,
+# ARGV[5] - where the order is posted, "orders", "pending" or "stream"
+# ARGV[6] - order codec, "json" or "hash", and only "json" for the orders list
+# Returns 1 if the order was created, 0 if the reservation no longer exists
+confirm_lua = """
+local function store_order(key, purchase)
+  if ARGV[6] == 'hash' then
+    redis.call('HSET', key, 'w', purchase['who'], 'q', purchase['qty'], 't', purchase['ts'],
+               'c', purchase['cost'], 'o', purchase['order_id'], 'e', purchase['event'])
+  else
+    redis.call('SET', key, cjson.encode(purchase))
+  end
+end
+local function push_order(key, purchase)
+  -- A list element is a single string, so there is no hash encoding here, and
+  -- lua_reserve refuses any codec other than JSON before the script runs
+  if ARGV[6] == 'json' then
+    redis.call('LPUSH', key, cjson.encode(purchase))
+  end
+end
+local qty = tonumber(redis.call('HGET', KEYS[1], 'reservations-user:' .. ARGV[1]))
+if not qty then
+  return 0
+end
+local price = tonumber(redis.call('HGET', KEYS[1], 'price'))
+redis.call('HINCRBY', KEYS[1], 'reservations', -qty)
+redis.call('HDEL', KEYS[1], 'reservations-user:' .. ARGV[1], 'reservations-ts:' .. ARGV[1])
+redis.call('ZREM', KEYS[5], ARGV[1])
+local purchase = { who = ARGV[1], qty = qty, ts = tonumber(ARGV[4]),
+                   cost = qty * price, order_id = ARGV[2] }
+if ARGV[5] == 'pending' then
+  purchase['event'] = ARGV[3]
+  store_order(KEYS[3], purchase)
+  redis.call('LPUSH', KEYS[4], ARGV[2])
+elseif ARGV[5] == 'stream' then
+  -- The stream entry carries the whole order, so posting needs no extra read
+  purchase['event'] = ARGV[3]
+  store_order(KEYS[3], purchase)
+  redis.call('XADD', KEYS[6], '*', 'order_id', ARGV[2], 'who', ARGV[1], 'qty', qty,
+             'ts', ARGV[4], 'cost', purchase['cost'], 'event', ARGV[3])
+else
+  purchase['event'] = ARGV[3]
+  push_order(KEYS[2], purchase)
+end
+return 1
+"""
+
+# KEYS[1] - events:<event>, KEYS[2] - reservation deadlines of the event
+# ARGV[1] - user
+# Returns the quantity returned to the available stock
+backout_lua = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+local qty = tonumber(redis.call('HGET', KEYS[1], 'reservations-user:' .. ARGV[1]))
+if not qty then
+  return 0
+end
+redis.call('HINCRBY', KEYS[1], 'available', qty)
+redis.call('HINCRBY', KEYS[1], 'reservations', -qty)
+redis.call('HDEL', KEYS[1], 'reservations-user:' .. ARGV[1], 'reservations-ts:' .. ARGV[1])
+return qty
+"""
+
+reserve_script = redis.register_script(reserve_lua)
+confirm_script = redis.register_script(confirm_lua)
+backout_script = redis.register_script(backout_lua)
+
+# Every reservation is also held in a sorted set of users for the event, scored
+# by the time of the reservation, so that expired reservations can be found
+# without scanning the reservations
+
+def lua_reserve(user, event_name, qty, post_to="orders"):
+  # Returns the order id, or None if the purchase was not made. The script can
+  # only store orders as JSON or as a hash, and only push them onto the orders
+  # list as JSON, so the other codecs are refused before anything is reserved
+  if post_to == "orders" and order_codec['name'] != "json":
+    raise ValueError("{} orders can not be pushed onto a list by a script".format(order_codec['name']))
+  if post_to != "orders" and order_codec['name'] not in ["json", "hash"]:
+    raise ValueError("{} orders can not be stored by a script".format(order_codec['name']))
+  if reserve_script(keys=["events:" + event_name, reservation_deadlines_key(event_name)],
+                    args=[user, qty, long(time.time())]) != 1:
+    return None
+  order_id = generate_order_id()
+  if creditcard_auth(user):
+    if confirm_script(keys=["events:" + event_name, "orders:" + event_name,
+                            "purchase_orders:" + order_id, "pending:" + event_name,
+                            reservation_deadlines_key(event_name), "pending_orders"],
+                      args=[user, order_id, event_name, long(time.time()), post_to,
+                            order_codec['name']]) == 1:
+      return order_id
+  else:
+    print "Auth failure on order {} for {}".format(order_id, user)
+    lua_backout_reservation(user, event_name)
+  return None
+
+def lua_reserve_with_pending(user, event_name, qty):
+  return lua_reserve(user, event_name, qty, post_to="pending")
+
+def lua_backout_reservation(user, event_name):
+  return backout_script(keys=["events:" + event_name, reservation_deadlines_key(event_name)],
+                        args=[user])
+
+for_event = "Mens Marathon Final"
+create_event(for_event, 500, 9)
+print lua_reserve(requestor, for_event, 5)
+print lua_reserve_with_pending("Amy", for_event, 3)
+print redis.lrange("orders:" + for_event, 0, -1)
+print redis.lrange("pending:" + for_event, 0, -1)
+print redis.hgetall("events:" + for_event)
+
+# Benchmark the WATCH and Lua reservations with an increasing number of clients
+def reserving_client(reserve_fn, event_name, reservations, results):
+  for i in range(reservations):
+    reserve_fn("Buyer-" + str(random.randrange(1000000000)), event_name, 1)
+  results.append(reservations)
+
+def benchmark_reserve(reserve_fn, clients, reservations):
+  event_name = "Reserve Event:" + reserve_fn.__name__ + ":" + str(clients)
+  create_event(event_name, 1000000, 9)
+  for stat in transaction_stats:
+    transaction_stats[stat] = 0
+  results = []
+  threads = []
+  for i in range(clients):
+    threads.append(threading.Thread(target=reserving_client,
+                                    args=(reserve_fn, event_name, reservations, results)))
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  sold = redis.llen("orders:" + event_name)
+  print "{:<12} clients:{:>3} sold:{:>6} sold/sec:{:>9.1f} available:{} transactions:{}".format(
+    reserve_fn.__name__, clients, sold, sold / elapsed, redis.hget("events:" + event_name, "available"),
+    transaction_stats)
+
+for clients in [1, 4, 16, 64]:
+  benchmark_reserve(reserve, clients, 200)
+  benchmark_reserve(lua_reserve, clients, 200)
+
+# Part Seven - Sorted set reservation expiry
+# The sweeper reads only the expired reservations from the sorted set of each
+# event, oldest first, and backs them out in batches, one script call per batch.
+
+# KEYS[1] - events:<event>, KEYS[2] - reservation deadlines of the event
+# ARGV[1] - cutoff_ts, followed by the users
+# Returns the number of reservations expired
+expire_lua = """
+local cutoff_ts = tonumber(ARGV[1])
+local expired = 0
+for i = 2, #ARGV do
+  local ts = redis.call('ZSCORE', KEYS[2], ARGV[i])
+  if ts and tonumber(ts) <= cutoff_ts then
+    redis.call('ZREM', KEYS[2], ARGV[i])
+    local user = ARGV[i]
+    local qty = tonumber(redis.call('HGET', KEYS[1], 'reservations-user:' .. user))
+    if qty then
+      redis.call('HINCRBY', KEYS[1], 'available', qty)
+      redis.call('HINCRBY', KEYS[1], 'reservations', -qty)
+      redis.call('HDEL', KEYS[1], 'reservations-user:' .. user, 'reservations-ts:' .. user)
+      expired = expired + 1
+    end
+  end
+end
+return expired
+"""
+expire_script = redis.register_script(expire_lua)
+
+def sweep_reservations(batch_size):
+  # Returns the number of reservations expired
+  cutoff_ts = long(time.time()-30)
+  expired = 0
+  # There is one sorted set per event with reservations, rather than one per
+  # reservation, so this scan is cheap
+  for key in redis.scan_iter(match="reservation_deadlines:*"):
+    event_name = key[len("reservation_deadlines:{events:"):-1]
+    while True:
+      users = redis.zrangebyscore(key, "-inf", cutoff_ts, start=0, num=batch_size)
+      if len(users) == 0:
+        break
+      expired += expire_script(keys=["events:" + event_name, key], args=[cutoff_ts] + users)
+  return expired
+
+def create_expired_reservations(event_name):
+  create_event(event_name, 500, 9)
+  for (user, qty, age) in [("Fred", 3, 16), ("Jim", 5, 42), ("Amy", 7, 31)]:
+    reserve_script(keys=["events:" + event_name, reservation_deadlines_key(event_name)],
+                   args=[user, qty, long(time.time() - age)])
+
+for_event = "Mens Javelin"
+create_expired_reservations(for_event)
+create_expired_reservations("Womens Hammer")
+print "Expired:{}".format(sweep_reservations(100))
+print redis.hgetall("events:" + for_event)
+print redis.zrange(reservation_deadlines_key(for_event), 0, -1, withscores=True)
+
+# Part Eight - Posting purchases from a stream
+# Confirmed orders are added to the pending_orders stream, carrying the whole
+# order. Posting workers read batches through a consumer group, and an order
+# is only acknowledged once it has been posted, so orders read by a worker
+# that crashes are claimed and posted by another.
+def lua_reserve_with_stream(user, event_name, qty):
+  return lua_reserve(user, event_name, qty, post_to="stream")
+
+def create_posting_group():
+  try:
+    redis.xgroup_create("pending_orders", "posting", id="0", mkstream=True)
+  except ResponseError:
+    # The group already exists
+    pass
+
+# KEYS[1] - invoices:<who>, KEYS[2] - sales:<event>, KEYS[3] - sales_summary,
+# KEYS[4] - sales histogram, KEYS[5] - sales histogram for the event,
+# KEYS[6] - pending_orders
+# ARGV[1] - order_id, ARGV[2] - event, ARGV[3] - cost, ARGV[4] - qty,
+# ARGV[5] - histogram bucket, ARGV[6] - stream entry id,
+# ARGV[7] - histogram counter type, ARGV[8] - histogram overflow policy,
+# ARGV[9] - histogram expiry
+# The totals are only added the first time an order is posted, so posting an
+# order again after a failure does not count it twice
+post_order_lua = """
+redis.call('SADD', KEYS[1], ARGV[1])
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+  redis.call('HINCRBYFLOAT', KEYS[3], ARGV[2] .. ':total_sales', ARGV[3])
+  redis.call('HINCRBY', KEYS[3], ARGV[2] .. ':total_tickets_sold', ARGV[4])
+  for i = 4, 5 do
+    redis.call('BITFIELD', KEYS[i], 'OVERFLOW', ARGV[8], 'INCRBY', ARGV[7], ARGV[5], ARGV[4])
+    redis.call('EXPIREAT', KEYS[i], ARGV[9])
+  end
+end
+redis.call('XACK', KEYS[6], 'posting', ARGV[6])
+redis.call('XDEL', KEYS[6], ARGV[6])
+return 1
+"""
+post_order_script = redis.register_script(post_order_lua)
+
+def post_stream_entries(entries):
+  # Post a batch of (id, order) stream entries in a single round trip
+  p = redis.pipeline(transaction=False)
+  for (entry_id, order) in entries:
+    ts = long(order['ts'])
+    post_order_script(keys=["invoices:" + order['who'], "sales:" + order['event'], "sales_summary",
+                            histogram_key(sales_histogram, "sales_histogram", ts),
+                            histogram_key(sales_histogram, "sales_histogram:" + order['event'], ts),
+                            "pending_orders"],
+                      args=[order['order_id'], order['event'], order['cost'], order['qty'],
+                            "#" + str(histogram_bucket(sales_histogram, ts)), entry_id,
+                            sales_histogram['type'], sales_histogram['overflow'],
+                            histogram_expiry(sales_histogram, ts)],
+                      client=p)
+  p.execute()
+  return len(entries)
+
+def post_stream_purchases(consumer, batch_size, block_ms):
+  # Returns the number of orders posted
+  streams = redis.xreadgroup("posting", consumer, {"pending_orders": ">"},
+                             count=batch_size, block=block_ms)
+  if not streams:
+    return 0
+  return post_stream_entries(streams[0][1])
+
+def recover_stream_purchases(consumer, min_idle_ms, batch_size):
+  # Claim and post the orders that other consumers read but never acknowledged
+  recovered = 0
+  start = "0-0"
+  while True:
+    reply = redis.execute_command("XAUTOCLAIM", "pending_orders", "posting", consumer,
+                                  min_idle_ms, start, "COUNT", batch_size)
+    (start, claimed) = (reply[0], reply[1])
+    entries = [(entry[0], dict(zip(entry[1][::2], entry[1][1::2]))) for entry in claimed if entry[1]]
+    recovered += post_stream_entries(entries)
+    if start == "0-0":
+      return recovered
+
+create_posting_group()
+for_event = "Mens Hammer"
+create_event(for_event, 500, 12)
+for who in ["Fred", "Amy", "Jim"]:
+  lua_reserve_with_stream(who, for_event, 2)
+# A consumer reads the orders and then crashes, before they are acknowledged
+redis.xreadgroup("posting", "crashed", {"pending_orders": ">"}, count=10)
+print "Posted:{}".format(post_stream_purchases("poster-1", 10, 100))
+print "Recovered:{}".format(recover_stream_purchases("poster-1", 0, 10))
+print "Sales: {}".format(redis.smembers("sales:" + for_event))
+print "Sales Summary: {}".format(redis.hgetall("sales_summary"))
+
+# Drain the stream with an increasing number of posting workers
+def posting_worker(consumer, batch_size, results):
+  posted = 0
+  while True:
+    batch = post_stream_purchases(consumer, batch_size, 100)
+    if batch == 0:
+      break
+    posted += batch
+  results.append(posted)
+
+def benchmark_stream_posting(workers, orders, batch_size):
+  p = redis.pipeline(transaction=False)
+  for i in range(orders):
+    p.xadd("pending_orders", { 'order_id': generate_order_id() + str(i), 'who': "User-" + str(i % 100),
+                               'qty': 1, 'ts': long(time.time()), 'cost': 9,
+                               'event': "Stream Event:" + str(workers) })
+  p.execute()
+  results = []
+  threads = []
+  for i in range(workers):
+    threads.append(threading.Thread(target=posting_worker,
+                                    args=("poster-" + str(i), batch_size, results)))
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  print "Workers:{:>3} posted:{:>6} orders/sec:{:>9.1f} pending:{}".format(
+    workers, sum(results), sum(results) / elapsed, redis.xpending("pending_orders", "posting")['pending'])
+
+for workers in [1, 2, 4, 8]:
+  benchmark_stream_posting(workers, 10000, 100)
+
+# Part Nine - Compare the order codecs
+order = { 'who': "Fred", 'qty': 5, 'ts': long(time.time()), 'cost': 45.0,
+          'order_id': generate_order_id(), 'event': "Mens 100m Final" }
+for codec in [json_codec, struct_codec, hash_codec]:
+  p = redis.pipeline()
+  store_order(p, order, codec)
+  p.execute()
+  print "{}: {}".format(codec['name'], load_order(order['order_id'], codec))
+
+# Compare the memory used and the encode / decode rate for each codec
+def benchmark_codec(codec, orders):
+  sample = [{ 'who': "User-" + str(i % 1000), 'qty': random.randrange(1, 10), 'ts': long(time.time()),
+              'cost': 9.0 * random.randrange(1, 10), 'order_id': codec['name'][0] + generate_order_id() + str(i % 100),
+              'event': "Womens 4x400m Final" } for i in range(orders)]
+  start = time.time()
+  encoded = [codec['encode'](o) for o in sample]
+  encode_rate = orders / (time.time() - start)
+  start = time.time()
+  for e in encoded:
+    codec['decode'](e)
+  decode_rate = orders / (time.time() - start)
+  p = redis.pipeline(transaction=False)
+  for o in sample:
+    store_order(p, o, codec)
+  p.execute()
+  for o in sample:
+    p.execute_command("MEMORY", "USAGE", "purchase_orders:" + o['order_id'])
+  memory = sum(p.execute())
+  print "{:<7} bytes/order:{:>6.1f} encodes/sec:{:>10.1f} decodes/sec:{:>10.1f}".format(
+    codec['name'], float(memory) / orders, encode_rate, decode_rate)
 
+for codec in [json_codec, struct_codec, hash_codec]:
+  benchmark_codec(codec, 10000)
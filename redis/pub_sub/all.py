@@ -1,9 +1,15 @@
-from redis import StrictRedis, WatchError
+from redis import StrictRedis, WatchError, ResponseError
 import os
 import time
 import random
 import string
 import threading
+import Queue
+import sys
+
+# The histogram helpers are shared with the inventory example
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from histogram import histogram_buckets, histogram_key, histogram_bucket, histogram_incr, histogram_read
 
 redis = StrictRedis(host=os.environ.get("REDIS_HOST", "localhost"), 
                     port=os.environ.get("REDIS_PORT", 6379),
@@ -17,18 +23,25 @@ def generate_order_id():
 def create_event(event_name):
 	redis.hmset("events:" + event_name, {'event': event_name})
 
-def purchase(event_name):
+def purchase(event_name, post=None):
 	qty = random.randrange(1, 10)
 	price = 20
 	order_id = generate_order_id()
 	purchase = { 'who': "Jim", 'qty': qty, 'ts': long(time.time()), 'cost': qty * price, 
                'order_id': order_id, 'event': event_name }
-	post_purchases(order_id, purchase)
+	if post == None:
+		post_purchases(order_id, purchase)
+	else:
+		post(order_id, purchase)
 
 def post_purchases(order_id, purchase):
 	redis.hmset("purchase_order_details:" + order_id, purchase)
 	redis.publish("purchase_orders", order_id) 
 
+# Sales histogram - counter type (i.e. width), overflow policy (WRAP, SAT or
+# FAIL), resolution and the number of windows to retain
+sales_histogram = { 'type': "u32", 'overflow': "SAT", 'resolution': "hour", 'retention': 7 }
+
 def listener_sales_analytics(queue):
 	l = redis.pubsub(ignore_subscribe_messages=True)
 	l.subscribe(queue)
@@ -36,10 +49,8 @@ def listener_sales_analytics(queue):
 	for message in l.listen():
 		order_id = message['data']
 		order = redis.hgetall("purchase_order_details:" + order_id)
-		hour_of_day = int(time.strftime("%H", time.gmtime(long(order['ts']))))
-		vals = ["INCRBY", "u8", (hour_of_day+1) * 8, order['qty']]
-		p.execute_command("BITFIELD", "sales_histogram:time_of_day", *vals)
-		p.execute_command("BITFIELD", "sales_histogram:time_of_day:" + order['event'], *vals)
+		histogram_incr(p, sales_histogram, "sales_histogram", long(order['ts']), order['qty'])
+		histogram_incr(p, sales_histogram, "sales_histogram:" + order['event'], long(order['ts']), order['qty'])
 		p.execute()
 
 def listener_events_analytics(queue):
@@ -75,12 +86,10 @@ def print_statistics():
 			print "Event: {}".format(event_name)
 			print " Total Sales: ${}".format(redis.hget("sales_summary", event_name + ":total_sales"))
 			print " Total Tickets Sold: {}".format(redis.hget("sales_summary", event_name + ":total_tickets_sold"))
-			hist = redis.get("sales_histogram:time_of_day:" + event_name)
+			hist = histogram_read(redis, sales_histogram, "sales_histogram:" + event_name, time.time())
 			print " Histogram: ",
-			for i in range(0, 24):
-			  vals = ["GET", "u8", (i+1) * 8]
-			  total_sales = int(redis.execute_command("BITFIELD", "sales_histogram:time_of_day:" + event_name, *vals)[0])
-			  print " {}/{}".format(i, total_sales),
+			for i in range(histogram_buckets(sales_histogram)):
+				print " {}/{}".format(i, hist[i]),
 			print "\n"
 		time.sleep(1)
 	print "\n === END"
@@ -145,3 +154,294 @@ for i in range(50):
 	purchase(events[random.randrange(0, len(events))])
 	time.sleep(random.random())
 
+
+# Part Three - Durable delivery with Streams
+# The whole order is carried in the stream entry, so listeners do not read the
+# order back, and each type of listener has its own consumer group, so every type
+# receives every order. Entries stay pending until they are acknowledged, so a
+# listener that is slow or restarts carries on from where it left off
+orders_stream = "purchase_orders_stream"
+
+def post_purchases_stream(order_id, purchase):
+	redis.xadd(orders_stream, purchase)
+
+def create_listener_group(group, start_id="0"):
+	try:
+		redis.xgroup_create(orders_stream, group, id=start_id, mkstream=True)
+	except ResponseError:
+		# The group already exists
+		pass
+
+def replay_listener_group(group, from_id):
+	# Orders after from_id are delivered to the group again. Sets are unaffected
+	# by a replay, but counters will count the orders again
+	redis.xgroup_setid(orders_stream, group, from_id)
+
+def handle_sales_analytics(p, order):
+	histogram_incr(p, sales_histogram, "sales_histogram", long(order['ts']), order['qty'])
+	histogram_incr(p, sales_histogram, "sales_histogram:" + order['event'], long(order['ts']), order['qty'])
+
+def handle_events_analytics(p, order):
+	event_name = order['event']
+	p.sadd("sales:" + event_name, order['order_id'])
+	p.hincrbyfloat("sales_summary", event_name + ":total_sales", order['cost'])
+	p.hincrby("sales_summary", event_name + ":total_tickets_sold", order['qty'])
+
+def handle_customer_purchases(p, order):
+	p.sadd("invoices:" + order['who'], order['order_id'])
+
+def stream_listener(group, consumer, handle, batch_size=100, block_ms=1000):
+	create_listener_group(group)
+	# Start with the orders this consumer read, but did not acknowledge, before it
+	# was restarted, then read new orders
+	read_from = "0"
+	while True:
+		streams = redis.xreadgroup(group, consumer, {orders_stream: read_from},
+		                           count=batch_size, block=block_ms)
+		if not streams or len(streams[0][1]) == 0:
+			read_from = ">"
+			continue
+		entries = streams[0][1]
+		# The updates and the acknowledgement are applied in the same transaction
+		p = redis.pipeline()
+		for (entry_id, order) in entries:
+			handle(p, order)
+		p.xack(orders_stream, group, *[entry_id for (entry_id, _) in entries])
+		p.execute()
+
+def stream_id(entry_id):
+	(ms, seq) = entry_id.split("-")
+	return (long(ms), long(seq))
+
+def trim_orders_stream():
+	# Removes the orders that every group has read and acknowledged, i.e. those
+	# before the oldest pending order, or the last delivered order for a group with
+	# nothing pending. Returns the number of orders removed. XTRIM MINID requires
+	# Redis 6.2 or later
+	keep_from = None
+	for group in redis.xinfo_groups(orders_stream):
+		pending = redis.xpending(orders_stream, group['name'])
+		oldest = pending['min'] if pending['pending'] > 0 else group['last-delivered-id']
+		if keep_from == None or stream_id(oldest) < stream_id(keep_from):
+			keep_from = oldest
+	if keep_from == None:
+		return 0
+	return redis.execute_command("XTRIM", orders_stream, "MINID", keep_from)
+
+stream_listeners = { 'sales_analytics': handle_sales_analytics,
+                     'events_analytics': handle_events_analytics,
+                     'customer_purchases': handle_customer_purchases }
+
+threads_3 = []
+for (group, handle) in stream_listeners.items():
+	threads_3.append(threading.Thread(target=stream_listener, args=(group, "consumer-1", handle)))
+
+for i in range(len(threads_3)):
+	threads_3[i].setDaemon(True)
+	threads_3[i].start()
+
+events = ["Mens Marathon", "Womens Marathon"]
+for e in events:
+	create_event(e)
+
+for i in range(50):
+	purchase(events[random.randrange(0, len(events))], post=post_purchases_stream)
+
+time.sleep(2)
+for group in stream_listeners.keys():
+	print "Group: {} {}".format(group, redis.xpending(orders_stream, group))
+for e in events:
+	print "{}: Total Sales: ${} Sales: {}".format(e, redis.hget("sales_summary", e + ":total_sales"),
+	                                              redis.scard("sales:" + e))
+
+# Replaying the orders to the customer purchases does not change the invoices
+replay_listener_group("customer_purchases", "0")
+time.sleep(2)
+print "Invoices for Jim: {}".format(redis.scard("invoices:Jim"))
+
+# Every group has now read and acknowledged the orders, so they can be trimmed
+print "Trimmed: {} Length: {}".format(trim_orders_stream(), redis.xlen(orders_stream))
+
+# Part Four - Batched listeners
+# A batched listener collects up to batch_size order ids, or as many as arrive
+# within batch_ms of the first one, reads all the orders in one pipeline, and then
+# applies the updates for the whole batch, summed per key, in a single execute
+def next_batch(l, batch_size, batch_ms):
+	order_ids = []
+	deadline = None
+	while len(order_ids) < batch_size:
+		if deadline == None:
+			message = l.get_message(timeout=1.0)
+		elif deadline > time.time():
+			message = l.get_message(timeout=deadline - time.time())
+		else:
+			break
+		if message != None:
+			order_ids.append(message['data'])
+			if deadline == None:
+				deadline = time.time() + batch_ms / 1000.0
+		elif deadline != None:
+			break
+	return order_ids
+
+def batched_listener(queue, handle_batch, batch_size=100, batch_ms=50):
+	l = redis.pubsub(ignore_subscribe_messages=True)
+	l.subscribe(queue)
+	p = redis.pipeline(transaction=False)
+	while True:
+		order_ids = next_batch(l, batch_size, batch_ms)
+		if len(order_ids) > 0:
+			for order_id in order_ids:
+				p.hgetall("purchase_order_details:" + order_id)
+			orders = [order for order in p.execute() if len(order) > 0]
+			handle_batch(p, orders)
+			p.execute()
+
+def handle_sales_analytics_batch(p, orders):
+	totals = {}
+	for order in orders:
+		ts = long(order['ts'])
+		for name in ["sales_histogram", "sales_histogram:" + order['event']]:
+			bucket = (name, histogram_key(sales_histogram, name, ts), histogram_bucket(sales_histogram, ts))
+			(_, qty) = totals.get(bucket, (ts, 0))
+			totals[bucket] = (ts, qty + int(order['qty']))
+	for ((name, _, _), (ts, qty)) in totals.items():
+		histogram_incr(p, sales_histogram, name, ts, qty)
+
+def handle_events_analytics_batch(p, orders):
+	sales = {}
+	for order in orders:
+		(order_ids, cost, qty) = sales.get(order['event'], ([], 0, 0))
+		sales[order['event']] = (order_ids + [order['order_id']], cost + float(order['cost']), qty + int(order['qty']))
+	for (event_name, (order_ids, cost, qty)) in sales.items():
+		p.sadd("sales:" + event_name, *order_ids)
+		p.hincrbyfloat("sales_summary", event_name + ":total_sales", cost)
+		p.hincrby("sales_summary", event_name + ":total_tickets_sold", qty)
+
+def handle_customer_purchases_batch(p, orders):
+	invoices = {}
+	for order in orders:
+		invoices.setdefault(order['who'], []).append(order['order_id'])
+	for (who, order_ids) in invoices.items():
+		p.sadd("invoices:" + who, *order_ids)
+
+def benchmark_listener(listener, args, orders, done_set):
+	# The orders are all for one customer and event, so the listener is done when
+	# there are as many members in its invoices or sales set as orders
+	channel = "bench_orders:" + listener.__name__ + ":" + done_set
+	who = "Bench-" + channel
+	t = threading.Thread(target=listener, args=(channel,) + args)
+	t.setDaemon(True)
+	t.start()
+	# Allow the listener to subscribe
+	time.sleep(0.5)
+	p = redis.pipeline(transaction=False)
+	for i in range(orders):
+		order_id = who + ":" + str(i)
+		p.hmset("purchase_order_details:" + order_id, { 'who': who, 'qty': 1, 'ts': long(time.time()), 'cost': 20,
+		                                                'order_id': order_id, 'event': who })
+	p.execute()
+	start = time.time()
+	for i in range(orders):
+		p.publish(channel, who + ":" + str(i))
+	p.execute()
+	while redis.scard(done_set + ":" + who) < orders:
+		time.sleep(0.01)
+	elapsed = time.time() - start
+	print "{:<28} {:<9} orders:{} orders/sec:{:>9.1f}".format(listener.__name__, done_set, orders, orders / elapsed)
+
+benchmark_listener(listener_customer_purchases, (), 20000, "invoices")
+benchmark_listener(batched_listener, (handle_customer_purchases_batch, 100, 50), 20000, "invoices")
+benchmark_listener(listener_events_analytics, (), 20000, "sales")
+benchmark_listener(batched_listener, (handle_events_analytics_batch, 100, 50), 20000, "sales")
+
+# Part Five - Shared subscription dispatcher
+# A single connection subscribes once to each channel or pattern, and fans every
+# message out to the handlers registered for it. Each handler has its own bounded
+# queue and worker thread, so a slow handler only falls behind itself. If the
+# queue of a handler is full, the message is dropped for that handler, and counted
+def create_dispatcher(queue_size=10000):
+	return { 'pubsub': redis.pubsub(ignore_subscribe_messages=True), 'queue_size': queue_size, 'handlers': [] }
+
+def register_handler(dispatcher, name, channel, handle, pattern=False):
+	dispatcher['handlers'].append({ 'name': name, 'channel': channel, 'pattern': pattern, 'handle': handle,
+	                                'queue': Queue.Queue(maxsize=dispatcher['queue_size']),
+	                                'processed': 0, 'dropped': 0, 'lag': 0.0 })
+
+def handler_worker(handler):
+	while True:
+		(received, data) = handler['queue'].get()
+		# Lag is the time the message spent waiting in the queue of the handler
+		handler['lag'] = time.time() - received
+		handler['handle'](data)
+		handler['processed'] += 1
+
+def dispatch(dispatcher):
+	for message in dispatcher['pubsub'].listen():
+		received = time.time()
+		for handler in dispatcher['handlers']:
+			if handler['pattern']:
+				matched = message['type'] == "pmessage" and message['pattern'] == handler['channel']
+			else:
+				matched = message['type'] == "message" and message['channel'] == handler['channel']
+			if matched:
+				try:
+					handler['queue'].put_nowait((received, message['data']))
+				except Queue.Full:
+					handler['dropped'] += 1
+
+def start_dispatcher(dispatcher):
+	channels = set([h['channel'] for h in dispatcher['handlers'] if not h['pattern']])
+	patterns = set([h['channel'] for h in dispatcher['handlers'] if h['pattern']])
+	if len(channels) > 0:
+		dispatcher['pubsub'].subscribe(*channels)
+	if len(patterns) > 0:
+		dispatcher['pubsub'].psubscribe(*patterns)
+	threads = [threading.Thread(target=handler_worker, args=(h,)) for h in dispatcher['handlers']]
+	threads.append(threading.Thread(target=dispatch, args=(dispatcher,)))
+	for t in threads:
+		t.setDaemon(True)
+		t.start()
+
+def dispatcher_stats(dispatcher):
+	stats = {}
+	for h in dispatcher['handlers']:
+		stats[h['name']] = { 'processed': h['processed'], 'dropped': h['dropped'],
+		                     'backlog': h['queue'].qsize(), 'lag': round(h['lag'], 3) }
+	return stats
+
+def order_handler(handle):
+	# Adapts the stream handlers, which are given the order, to handle an Order Id
+	def handle_order_id(order_id):
+		order = redis.hgetall("purchase_order_details:" + order_id)
+		p = redis.pipeline()
+		handle(p, order)
+		p.execute()
+	return handle_order_id
+
+def slow_event_alerter(order_id):
+	time.sleep(0.2)
+	print "Purchase alert - Order Id: {}".format(order_id)
+
+def post_purchases_dispatched(order_id, purchase):
+	redis.hmset("purchase_order_details:" + order_id, purchase)
+	redis.publish("dispatched_orders", order_id)
+	redis.publish("dispatched_orders:" + purchase['event'], order_id)
+
+dispatcher = create_dispatcher(queue_size=1000)
+register_handler(dispatcher, "sales_analytics", "dispatched_orders", order_handler(handle_sales_analytics))
+register_handler(dispatcher, "events_analytics", "dispatched_orders", order_handler(handle_events_analytics))
+register_handler(dispatcher, "customer_purchases", "dispatched_orders", order_handler(handle_customer_purchases))
+register_handler(dispatcher, "event_alerter", "dispatched_orders:*", slow_event_alerter, pattern=True)
+start_dispatcher(dispatcher)
+time.sleep(0.5)
+
+events = ["Womens Triathlon", "Mens Triathlon"]
+for e in events:
+	create_event(e)
+
+for i in range(50):
+	purchase(events[random.randrange(0, len(events))], post=post_purchases_dispatched)
+	time.sleep(random.random() / 10)
+	if i % 10 == 9:
+		print dispatcher_stats(dispatcher)
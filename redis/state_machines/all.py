@@ -1,11 +1,18 @@
-from redis import StrictRedis, WatchError
+from redis import StrictRedis, ConnectionPool
 import os
 import time
 import random
 import string
 import json
 import uuid
+import gzip
 import threading
+import multiprocessing
+import sys
+
+# The transaction helpers are shared with the inventory example
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from transactions import transaction_stats, optimistic_transaction
 
 redis = StrictRedis(host=os.environ.get("REDIS_HOST", "localhost"), 
                     port=os.environ.get("REDIS_PORT", 6379),
@@ -22,24 +29,21 @@ def generate_token():
   return ''.join(random.choice(string.ascii_uppercase + string.digits) \
     for _ in range(6))
 
-def do_activate(event):
+def do_activate(event, r=redis):
   if event['token'] == "":
     event['token'] = generate_token()
-  try:
-    p = redis.pipeline()
-    redis.watch("accounts:" + event['device'])
-    account = redis.hgetall("accounts:" + event['device'])
-    if 'app:' + event['service'] not in account.keys():
+  def activate(p):
+    if not p.hexists("accounts:" + event['device'], 'app:' + event['service']):
       data = {}
       data['app:' + event['service'] + ':status'] = "Waiting"
       data['app:' + event['service'] + ':failed'] = 0
+      p.multi()
       p.hmset("accounts:" + event['device'], data)
       p.hsetnx("accounts:" + event['device'], 'app:' + event['service'], event['token'])
       p.execute()
-  except WatchError:
+  (applied, _) = optimistic_transaction(r, ["accounts:" + event['device']], activate)
+  if not applied:
     print "Write Conflict: {}".format("accounts:" + event['device'])
-  finally:
-    p.reset()
 
 device_id = "ATV-123"
 service1 = "Olympics 2020"
@@ -55,59 +59,61 @@ do_activate({'device': device_id, 'service': service2, 'token': ""})
 print redis.hgetall("accounts:" + device_id)
 
 # Part Two - Entitlement
-def do_entitlement(event):
-  p = redis.pipeline()
-  try:
-    redis.watch("accounts:" + event['device'])
-    account = redis.hgetall("accounts:" + event['device'])
-    if 'app:' + event['service'] in account.keys():
+def do_entitlement(event, r=redis):
+  # Only the fields of the service are read, not the whole account
+  service = 'app:' + event['service']
+  def entitle(p):
+    (service_token, status, failed, expires) = p.hmget("accounts:" + event['device'], service,
+                                                       service + ':status', service + ':failed',
+                                                       service + ':expires')
+    if service_token != None:
       service_rec = {}
-      if account['app:' + event['service'] + ':status'] == "Waiting":
-        if account['app:' + event['service']] == event['token']:
+      p.multi()
+      if status == "Waiting":
+        if service_token == event['token']:
           # Matching token, activate service
-          service_rec['app:' + event['service'] + ':failed'] = 0
-          service_rec['app:' + event['service'] + ':status'] = 'Active' 
+          service_rec[service + ':failed'] = 0
+          service_rec[service + ':status'] = 'Active' 
           p.hmset("accounts:" + event['device'], service_rec)
-          p.hsetnx("accounts:" + event['device'], 'app:' + event['service'] + ':expires', long(time.time() + token_expiration))
+          p.hsetnx("accounts:" + event['device'], service + ':expires', long(time.time() + token_expiration))
           p.execute()       
         else:
           # Token not matched, determine if the account needs to be suspended
-          if int(account['app:' + event['service'] + ':failed']) < 3:
+          if int(failed) < 3:
             # increment and update last timestamp
-            p.hincrby("accounts:" + event['device'], 'app:' + event['service'] + ':failed', 1)
+            p.hincrby("accounts:" + event['device'], service + ':failed', 1)
             p.execute()
           else:
             # Exceeded limit
-            service_rec['app:' + event['service'] + ':status'] = "Suspended"
+            service_rec[service + ':status'] = "Suspended"
             p.hmset("accounts:" + event['device'], service_rec)
             p.execute()
-      elif account['app:' + event['service'] + ':status'] == "Active":
-        if long(account['app:' + event['service'] + ':expires']) >= long(time.time()):
+      elif status == "Active":
+        if long(expires) >= long(time.time()):
           # Token not expired, so update
-          service_rec['app:' + event['service'] + ':failed'] = 0
+          service_rec[service + ':failed'] = 0
           p.hmset("accounts:" + event['device'], service_rec)
           p.execute()
         else:
           # Token expired, so suspend
-          service_rec['app:' + event['service'] + ':failed'] = 0
-          service_rec['app:' + event['service'] + ':status'] = 'Suspended' 
+          service_rec[service + ':failed'] = 0
+          service_rec[service + ':status'] = 'Suspended' 
           p.hmset("accounts:" + event['device'], service_rec)
-          p.hdel("accounts:" + event['device'], 'app:' + event['service'] + ':expires')
+          p.hdel("accounts:" + event['device'], service + ':expires')
           p.execute()
-      elif account['app:' + event['service'] + ':status'] == "Suspended":
+      elif status == "Suspended":
         # Generate new Token and transition back to Waiting state
         if event['token'] == "":
-          service_rec['app:' + event['service']] = generate_token()
+          service_rec[service] = generate_token()
         else:
-          service_rec['app:' + event['service']] = event['token']
-        service_rec['app:' + event['service'] + ':failed'] = 0
-        service_rec['app:' + event['service'] + ':status'] = 'Waiting' 
+          service_rec[service] = event['token']
+        service_rec[service + ':failed'] = 0
+        service_rec[service + ':status'] = 'Waiting' 
         p.hmset("accounts:" + event['device'], service_rec)
         p.execute()
-  except WatchError:
+  (applied, _) = optimistic_transaction(r, ["accounts:" + event['device']], entitle)
+  if not applied:
     print "Write Conflict: {}".format("accounts:" + event['device'])
-  finally:
-    p.reset()
 
 # Entitlement will move the state for "2020 Olympics", if the tokens match
 do_entitlement({'device': device_id, 'service': service1, 'token': token})
@@ -119,35 +125,70 @@ for i in range(4):
   print "service: {} is {}".format(service2, redis.hget("accounts:" + device_id, "app:" + service2 + ":status"))
 
 # Part Three - Wrap the process into the State Machines
-def do_start(event):
-  redis.incr("events_oustanding")
-
-def do_finish(event):
-  redis.decr("events_oustanding")
-
-def transition(queue, from_state, to_state, invoke):
+# Outstanding events are counted when they are created, rather than when they
+# start, so that a waiter can not miss an event that has yet to start
+def do_start(event, r=redis):
+  pass
+
+# Signals any waiters by pushing onto a list when the last outstanding event,
+# or the last event of a batch, has finished. A handler can run more than once
+# for an event (e.g. when a processing list is recovered), so the event is only
+# counted the first time, when the finished field is set on its payload
+#   KEYS[1] - event_payload:<id>, KEYS[2] - events_oustanding, KEYS[3] - events_drained
+#   KEYS[4] - batch_outstanding:<batch>, KEYS[5] - batch_done:<batch> (if in a batch)
+#   ARGV[1] - expiry of the batch_done key
+finish_lua = """
+if redis.call('HSETNX', KEYS[1], 'finished', 1) == 0 then
+  return 0
+end
+if redis.call('DECR', KEYS[2]) <= 0 then
+  redis.call('DEL', KEYS[3])
+  redis.call('RPUSH', KEYS[3], 1)
+end
+if #KEYS > 3 and redis.call('DECR', KEYS[4]) <= 0 then
+  redis.call('DEL', KEYS[4])
+  redis.call('RPUSH', KEYS[5], 1)
+  redis.call('EXPIRE', KEYS[5], ARGV[1])
+end
+return 1
+"""
+
+finish_script = redis.register_script(finish_lua)
+batch_expiration = 3600
+
+def do_finish(event, r=redis):
+  keys = ["event_payload:" + event['id'], "events_oustanding", "events_drained"]
+  if event.get('batch'):
+    keys += ["batch_outstanding:" + event['batch'], "batch_done:" + event['batch']]
+  finish_script(keys=keys, args=[batch_expiration], client=r)
+
+def transition(queue, from_state, to_state, invoke, r=redis):
   # Take the next todo and create new entries into each workflow
-  p = redis.pipeline()
-  id = redis.brpoplpush("events:" + queue + ":" + from_state, "events:" + queue + ":" + from_state, 1)
+  id = r.brpoplpush("events:" + queue + ":" + from_state, "events:" + queue + ":" + from_state, 1)
   if id != None:
-    try:
-      redis.watch("event_playload:" + id)
-      event = redis.hgetall("event_payload:" + id)
+    # The handler runs once, outside the transaction, so that it is not run again
+    # when the transaction is retried
+    event = r.hgetall("event_payload:" + id)
+    event['id'] = id
+    if event['last_step'] == from_state:
+      invoke(event, r)
+    def step(p):
+      event = p.hgetall("event_payload:" + id)
       if event['last_step'] == from_state:
-        invoke(event)
         data = { 'ts': long(time.time()), 'last_step': to_state }
+        p.multi()
         p.hmset("event_payload:" + id, data)
         p.execute()
         print "Executed: Q:{} ID:{} S:{} FN:{}".format(queue, id, from_state, invoke.__name__)
       elif event['last_step'] == to_state:
+        p.multi()
         p.lrem("events:" + queue + ":" + from_state, 0, id)
         p.lpush("events:" + queue + ":" + to_state, id)
         p.execute()   
         print "Transitioned: Q:{} ID:{} F:{} T:{}".format(queue, id, from_state, to_state)
-    except WatchError:
+    (applied, _) = optimistic_transaction(r, ["event_payload:" + id], step)
+    if not applied:
       print "Write Conflict: {}".format("event_payload:" + id)
-    finally:
-      p.reset()
 
 def process_start(queue):
   transition(queue, from_state="start", to_state="todo", invoke=do_start)
@@ -161,33 +202,73 @@ def process_entitlement(queue):
 def process_finish(queue):
   transition(queue, from_state="entitlement", to_state="end", invoke=do_finish)
 
-def create_activation(queue, device, service, token):
+def queue_activation(p, queue, device, service, token, batch=None):
   data = { 'service': service, 
            'device': device, 
            'token': token,
            'last_step': "start",
            'ts': 0
           }
+  if batch != None:
+    data['batch'] = batch
   id = str(uuid.uuid4())
-  p = redis.pipeline()
   p.rpush("events:" + queue + ":start", id)
   p.hmset("event_payload:" + id, data)
-  # p.expire("event_payload:" + id, 120)
+  # Payloads are removed once they are archived, see archive_completed
+
+def create_activation(queue, device, service, token):
+  p = redis.pipeline()
+  p.incr("events_oustanding")
+  queue_activation(p, queue, device, service, token)
   p.execute()
 
-# Create the activation event
+# Batch completion
+# Each batch counts its own outstanding events, and do_finish pushes onto the
+# batch_done list when the last one finishes. The batch id acts as a future:
+# waiting on it blocks until the batch is done, for any number of waiters
+def create_batch(queue, activations):
+  # activations is a list of (device, service, token), returns the batch id
+  batch = str(uuid.uuid4())
+  p = redis.pipeline()
+  p.incrby("events_oustanding", len(activations))
+  if len(activations) == 0:
+    p.rpush("batch_done:" + batch, 1)
+    p.expire("batch_done:" + batch, batch_expiration)
+  else:
+    p.set("batch_outstanding:" + batch, len(activations))
+  for (device, service, token) in activations:
+    queue_activation(p, queue, device, service, token, batch)
+  p.execute()
+  return batch
+
+def wait_for_batch(batch, timeout=0):
+  # Returns True once the batch is done, or False if the timeout (in seconds)
+  # expired first. The signal is rotated back onto the list, rather than
+  # removed, so that every waiter sees it
+  return redis.brpoplpush("batch_done:" + batch, "batch_done:" + batch, timeout) != None
+
+def batch_done(batch):
+  return redis.exists("batch_done:" + batch)
+
+# Create the activation event, as a batch of one
 device_id = "MYTV-678"
 create_account(device_id)
-create_activation("new-device", device_id, "CNN", token)
+batch = create_batch("new-device", [(device_id, "CNN", token)])
 
-# Process the outstanding todo
-while True:
-  process_start("new-device")
-  process_activation("new-device")
-  process_entitlement("new-device")
-  process_finish("new-device")
-  if int(redis.get("events_oustanding")) == 0:
-    break
+# Process the outstanding todo until the batch is done
+def process_all(queue, stop):
+  while not stop.is_set():
+    process_start(queue)
+    process_activation(queue)
+    process_entitlement(queue)
+    process_finish(queue)
+
+stop = threading.Event()
+driver = threading.Thread(target=process_all, args=("new-device", stop))
+driver.start()
+wait_for_batch(batch)
+stop.set()
+driver.join()
 
 print redis.hgetall("accounts:" + device_id)
 
@@ -210,10 +291,11 @@ def thread_Finish(queue):
     process_finish(queue)
 
 def wait_for_queues_to_empty():
-  while True:
-    time.sleep(1)
-    if int(redis.get("events_oustanding")) == 0:
-      break  
+  # Blocks until do_finish signals that there are no outstanding events. A signal
+  # left from an earlier batch just causes the count to be checked again, and the
+  # timeout only guards against another waiter taking the signal
+  while int(redis.get("events_oustanding") or 0) > 0:
+    redis.blpop("events_drained", 1)
 
 threads = []
 threads.append(threading.Thread(target=thread_Start, args=("new-device",)))
@@ -256,5 +338,462 @@ create_activation("new-device", device_id, service2, valid_token)
 wait_for_queues_to_empty()
 print redis.hgetall("accounts:" + device_id)
 
+# Part Five - Blocking transitions
+# Each worker moves the next event from the stage onto its own processing list
+# with BLMOVE, so an event is only ever seen once, and acknowledging it is a single
+# O(1) move from the processing list onto the next stage. BLMOVE requires Redis 6.2
+stages = [ ("start", "todo", do_start),
+           ("todo", "provision", do_activate),
+           ("provision", "entitlement", do_entitlement),
+           ("entitlement", "end", do_finish) ]
+
+def processing_list(queue, state, worker):
+  return "events:" + queue + ":" + state + ":processing:" + worker
+
+def complete_transition(queue, from_state, to_state, invoke, processing, id, r=redis):
+  event = r.hgetall("event_payload:" + id)
+  event['id'] = id
+  # The last_step and the ack are written together, so an event on a processing
+  # list has never completed the step. If the worker failed while running the
+  # handler, the handler runs again on recovery, i.e. delivery is at least once
+  invoke(event, r)
+  p = r.pipeline()
+  p.hmset("event_payload:" + id, { 'ts': long(time.time()), 'last_step': to_state })
+  p.rpoplpush(processing, "events:" + queue + ":" + to_state)
+  p.hincrby("stage_stats:" + queue, from_state, 1)
+  p.execute()
 
+def blocking_transition(queue, from_state, to_state, invoke, worker, timeout=1, r=redis):
+  processing = processing_list(queue, from_state, worker)
+  id = r.execute_command("BLMOVE", "events:" + queue + ":" + from_state, processing,
+                         "RIGHT", "LEFT", timeout)
+  if id != None:
+    complete_transition(queue, from_state, to_state, invoke, processing, id, r)
+  return id
+
+def recover_transitions(queue, from_state, to_state, invoke, worker, r=redis):
+  # Complete any events left on the processing list by a previous run of the worker
+  processing = processing_list(queue, from_state, worker)
+  id = r.lindex(processing, -1)
+  while id != None:
+    complete_transition(queue, from_state, to_state, invoke, processing, id, r)
+    id = r.lindex(processing, -1)
+
+def stage_worker(queue, from_state, to_state, invoke, worker):
+  recover_transitions(queue, from_state, to_state, invoke, worker)
+  while True:
+    blocking_transition(queue, from_state, to_state, invoke, worker)
+
+def create_activations(queue, events, devices):
+  services = [service1, service2, "CNN"]
+  for i in range(devices):
+    create_account("BENCH-" + str(i))
+  redis.incrby("events_oustanding", events)
+  p = redis.pipeline(transaction=False)
+  for i in range(events):
+    queue_activation(p, queue, "BENCH-" + str(i % devices), services[i % len(services)], token)
+    if i % 1000 == 999:
+      p.execute()
+  p.execute()
 
+def benchmark_blocking_transitions(events, devices=1000):
+  queue = "bench-" + str(events)
+  create_activations(queue, events, devices)
+  for (from_state, to_state, invoke) in stages:
+    t = threading.Thread(target=stage_worker, args=(queue, from_state, to_state, invoke, "w0"))
+    t.setDaemon(True)
+    t.start()
+  start = time.time()
+  while redis.llen("events:" + queue + ":end") < events:
+    time.sleep(0.1)
+  elapsed = time.time() - start
+  print "events:{} elapsed:{:.2f}s events/sec:{:.1f}".format(events, elapsed, events / elapsed)
+
+benchmark_blocking_transitions(100000)
+
+# Part Six - Stage worker pools
+# Each stage runs a pool of workers, as threads or processes, sharing a connection
+# pool of their own, so a slow stage (e.g. provision, which runs do_entitlement)
+# can be scaled on its own. A worker stops taking events while the next stage has
+# max_depth or more events queued, and finishes its current event before stopping
+def pooled_stage_worker(queue, from_state, to_state, invoke, worker, stop, max_depth, r, stats_key=None):
+  before = dict(transaction_stats)
+  recover_transitions(queue, from_state, to_state, invoke, worker, r)
+  while not stop.is_set():
+    if max_depth != None and r.llen("events:" + queue + ":" + to_state) >= max_depth:
+      time.sleep(0.1)
+    else:
+      blocking_transition(queue, from_state, to_state, invoke, worker, r=r)
+  if stats_key != None:
+    # A worker process counts into its own copy of transaction_stats, so it adds
+    # its counts to a hash that the parent can read
+    p = r.pipeline()
+    for (stat, count) in transaction_stats.items():
+      p.hincrby(stats_key, stat, count - before[stat])
+    p.execute()
+
+def start_stages(queue, pool_sizes, mode="thread", max_depth=1000):
+  # pool_sizes is the number of workers for each stage, e.g. { 'provision': 4 },
+  # and defaults to one worker
+  if mode == "thread":
+    stop = threading.Event()
+  else:
+    stop = multiprocessing.Event()
+  workers = []
+  for i in range(len(stages)):
+    (from_state, to_state, invoke) = stages[i]
+    # Connection pools are re-created by each process after the fork
+    r = StrictRedis(connection_pool=ConnectionPool(host=os.environ.get("REDIS_HOST", "localhost"),
+                                                   port=os.environ.get("REDIS_PORT", 6379),
+                                                   db=0))
+    # Nothing consumes the end of the state machine, so there is no limit on it
+    depth = max_depth if i < len(stages) - 1 else None
+    for n in range(pool_sizes.get(from_state, 1)):
+      # Worker names are stable, so a restarted worker recovers its processing list
+      args = (queue, from_state, to_state, invoke, from_state + "-" + str(n), stop, depth, r)
+      if mode == "thread":
+        w = threading.Thread(target=pooled_stage_worker, args=args)
+      else:
+        w = multiprocessing.Process(target=pooled_stage_worker,
+                                    args=args + ("transaction_stats:" + queue,))
+      w.daemon = True
+      w.start()
+      workers.append(w)
+  return { 'queue': queue, 'stop': stop, 'workers': workers }
+
+def stop_stages(runner):
+  runner['stop'].set()
+  for w in runner['workers']:
+    w.join()
+
+def stage_stats(queue, interval=1):
+  # Returns the depth and the processing rate (events/sec) of each stage
+  before = redis.hgetall("stage_stats:" + queue)
+  time.sleep(interval)
+  after = redis.hgetall("stage_stats:" + queue)
+  stats = {}
+  for (from_state, _, _) in stages:
+    processed = int(after.get(from_state, 0)) - int(before.get(from_state, 0))
+    stats[from_state] = { 'depth': redis.llen("events:" + queue + ":" + from_state),
+                          'rate': processed / float(interval) }
+  return stats
+
+def benchmark_stage_pools(events, pool_sizes, mode):
+  queue = "pool-" + mode + "-" + str(pool_sizes.get("provision", 1))
+  create_activations(queue, events, 1000)
+  before = dict(transaction_stats)
+  start = time.time()
+  runner = start_stages(queue, pool_sizes, mode)
+  while redis.llen("events:" + queue + ":end") < events:
+    print "  {}".format(stage_stats(queue))
+  elapsed = time.time() - start
+  stop_stages(runner)
+  if mode == "thread":
+    stats = dict([(stat, count - before[stat]) for (stat, count) in transaction_stats.items()])
+  else:
+    # Each worker process adds its counts to the hash as it stops
+    stats = dict([(stat, int(count)) for (stat, count) in redis.hgetall("transaction_stats:" + queue).items()])
+  print "mode:{} pools:{} events/sec:{:.1f} transactions:{}".format(mode, pool_sizes, events / elapsed,
+                                                                   stats)
+
+for mode in ["thread", "process"]:
+  for provision_workers in [1, 4]:
+    benchmark_stage_pools(20000, { 'todo': 2, 'provision': provision_workers }, mode)
+
+# Part Seven - Entitlement as a Lua script
+# The whole Waiting / Active / Suspended transition table runs on the server, so
+# there is a single round trip and nothing to watch or retry
+#   KEYS[1] - accounts:<device>
+#   ARGV[1] - service, ARGV[2] - token, ARGV[3] - now, ARGV[4] - token expiration,
+#   ARGV[5] - token to use when a Suspended service moves back to Waiting
+# Returns the status of the service, or nil if the service is not provisioned
+entitlement_lua = """
+local service = 'app:' .. ARGV[1]
+local fields = redis.call('HMGET', KEYS[1], service, service .. ':status',
+                          service .. ':failed', service .. ':expires')
+if not fields[1] then
+  return false
+end
+local status = fields[2]
+if status == 'Waiting' then
+  if fields[1] == ARGV[2] then
+    -- Matching token, activate service
+    redis.call('HMSET', KEYS[1], service .. ':failed', 0, service .. ':status', 'Active')
+    redis.call('HSETNX', KEYS[1], service .. ':expires', tonumber(ARGV[3]) + tonumber(ARGV[4]))
+    return 'Active'
+  elseif tonumber(fields[3]) < 3 then
+    redis.call('HINCRBY', KEYS[1], service .. ':failed', 1)
+  else
+    -- Exceeded limit
+    redis.call('HSET', KEYS[1], service .. ':status', 'Suspended')
+    return 'Suspended'
+  end
+elseif status == 'Active' then
+  if tonumber(fields[4]) >= tonumber(ARGV[3]) then
+    -- Token not expired, so update
+    redis.call('HSET', KEYS[1], service .. ':failed', 0)
+  else
+    -- Token expired, so suspend
+    redis.call('HMSET', KEYS[1], service .. ':failed', 0, service .. ':status', 'Suspended')
+    redis.call('HDEL', KEYS[1], service .. ':expires')
+    return 'Suspended'
+  end
+elseif status == 'Suspended' then
+  -- New Token and transition back to Waiting state
+  redis.call('HMSET', KEYS[1], service, ARGV[5], service .. ':failed', 0, service .. ':status', 'Waiting')
+  return 'Waiting'
+end
+return status
+"""
+
+entitlement_script = redis.register_script(entitlement_lua)
+
+def lua_entitlement(event, r=redis):
+  new_token = event['token'] if event['token'] != "" else generate_token()
+  return entitlement_script(keys=["accounts:" + event['device']],
+                            args=[event['service'], event['token'], long(time.time()),
+                                  token_expiration, new_token], client=r)
+
+def benchmark_entitlement(entitle_fn, services, events):
+  device = "BENCH-" + entitle_fn.__name__ + "-" + str(services)
+  create_account(device)
+  for i in range(services):
+    do_activate({'device': device, 'service': "svc-" + str(i), 'token': token})
+  start = time.time()
+  for i in range(events):
+    entitle_fn({'device': device, 'service': "svc-" + str(i % services), 'token': token})
+  elapsed = time.time() - start
+  print "{:<16} services:{:>4} entitlements/sec:{:>9.1f} account fields:{}".format(
+    entitle_fn.__name__, services, events / elapsed, redis.hlen("accounts:" + device))
+
+for services in [1, 10, 100, 500]:
+  benchmark_entitlement(do_entitlement, services, 5000)
+  benchmark_entitlement(lua_entitlement, services, 5000)
+
+# Part Eight - Batch completion
+device_id = "MYTV-BATCH"
+create_account(device_id)
+batches = []
+for b in range(3):
+  batches.append(create_batch("new-device", [(device_id, "svc-" + str(b) + "-" + str(i), token) for i in range(10)]))
+for batch in batches:
+  start = time.time()
+  print "batch:{} done:{} waited:{:.3f}s".format(batch, wait_for_batch(batch, timeout=60), time.time() - start)
+print "all done:{} outstanding:{}".format(all([batch_done(b) for b in batches]), redis.get("events_oustanding"))
+
+# Part Nine - Retention of completed events
+# Completed events are archived, oldest first, once they have been complete for
+# longer than the retention. Each batch is appended to the archive as gzipped JSON
+# lines (or just dropped if there is no archive), and then the payloads are
+# deleted and the end list is trimmed. A failure after the write, but before the
+# trim, means the batch is archived again next time
+retention = { 'seconds': 3600,
+              'batch_size': 1000,
+              'archive': os.path.join(os.environ.get("ARCHIVE_DIR", "/tmp"), "completed_events.json.gz") }
+
+def archive_completed(queue, retention, now=None):
+  # Returns the number of events archived
+  cutoff_ts = (now or time.time()) - retention['seconds']
+  end = "events:" + queue + ":end"
+  # Events are pushed onto the head of the list, so the oldest are at the tail
+  ids = redis.lrange(end, -retention['batch_size'], -1)
+  ids.reverse()
+  p = redis.pipeline(transaction=False)
+  for id in ids:
+    p.hgetall("event_payload:" + id)
+  expired = []
+  for (id, payload) in zip(ids, p.execute()):
+    if len(payload) > 0 and long(payload['ts']) >= cutoff_ts:
+      break
+    expired.append((id, payload))
+  if len(expired) == 0:
+    return 0
+  if retention['archive'] != None:
+    f = gzip.open(retention['archive'], "ab")
+    try:
+      for (id, payload) in expired:
+        payload['id'] = id
+        f.write(json.dumps(payload) + "\n")
+    finally:
+      f.close()
+  p = redis.pipeline()
+  for (id, _) in expired:
+    p.delete("event_payload:" + id)
+  # Only the archiver removes from the tail, so this is safe with concurrent pushes
+  p.ltrim(end, 0, -(len(expired) + 1))
+  p.execute()
+  return len(expired)
+
+def archive_queue(queue, retention, now=None):
+  archived = 0
+  while True:
+    n = archive_completed(queue, retention, now)
+    archived += n
+    if n < retention['batch_size']:
+      return archived
+
+def read_archive(path):
+  f = gzip.open(path, "rb")
+  try:
+    for line in f:
+      yield json.loads(line)
+  finally:
+    f.close()
+
+for queue in ["new-device", "bench-100000"]:
+  before = redis.info("memory")['used_memory']
+  # Archive everything that has completed, rather than waiting for the retention
+  archived = archive_queue(queue, dict(retention, seconds=0))
+  print "queue:{} archived:{} end:{} memory freed:{}".format(queue, archived,
+    redis.llen("events:" + queue + ":end"), before - redis.info("memory")['used_memory'])
+print "archive:{} events:{}".format(retention['archive'], sum([1 for _ in read_archive(retention['archive'])]))
+
+# Part Ten - Declarative workflows
+# A workflow is defined as data: each state names its handler, its next states
+# and how many workers it runs, so it can be loaded from JSON and tuned without
+# code changes. A state with several next states fans out, and a state that is
+# the next state of several others is a join, which is only entered once every
+# incoming branch has completed. States with no definition (e.g. end) are final.
+handlers = { 'do_start': do_start, 'do_activate': do_activate,
+             'do_entitlement': do_entitlement, 'do_finish': do_finish }
+
+def do_notify(event, r=redis):
+  r.rpush("notifications:" + event['device'], event['service'])
+
+handlers['do_notify'] = do_notify
+
+activation_workflow = {
+  'start':       { 'handler': "do_start", 'next': ["todo"] },
+  'todo':        { 'handler': "do_activate", 'next': ["provision", "notify"], 'workers': 2 },
+  'provision':   { 'handler': "do_entitlement", 'next': ["entitlement"], 'workers': 4 },
+  'notify':      { 'handler': "do_notify", 'next': ["entitlement"] },
+  'entitlement': { 'handler': "do_finish", 'next': ["end"] }
+}
+
+def compile_workflow(workflow, handlers):
+  # Returns the transition table, i.e. for each state the handler, the number of
+  # workers and the list of (next state, number of branches that join there)
+  joins = {}
+  for definition in workflow.values():
+    for next_state in definition['next']:
+      joins[next_state] = joins.get(next_state, 0) + 1
+  table = {}
+  for (state, definition) in workflow.items():
+    table[state] = { 'handler': handlers[definition['handler']],
+                     'workers': definition.get('workers', 1),
+                     'next': [(n, joins[n]) for n in definition['next']] }
+  return table
+
+# Completes a step: marks it as done, pushes the event onto the next states and
+# removes it from the processing list, all atomically. The done marker is also
+# a guard, so the step is never completed twice even if the event is queued twice
+#   KEYS[1] - processing list, KEYS[2] - event_payload:<id>, KEYS[3] - workflow_stats:<queue>
+#   then for each next state KEYS[n] - events:<queue>:<next>, KEYS[n+1] - join:<queue>:<next>:<id>
+#   ARGV[1] - state, ARGV[2] - ts, ARGV[3] - handler time (ms), ARGV[4] - id
+#   then for each next state ARGV[n] - next state, ARGV[n+1] - branches joining there
+# Returns 1 if the step was completed, or 0 if it had already been completed
+workflow_step_lua = """
+local completed = redis.call('HSETNX', KEYS[2], 'done:' .. ARGV[1], ARGV[2])
+if completed == 1 then
+  for k = 0, (#KEYS - 3) / 2 - 1 do
+    local joins = tonumber(ARGV[6 + 2 * k])
+    if joins <= 1 then
+      redis.call('LPUSH', KEYS[4 + 2 * k], ARGV[4])
+    elseif redis.call('INCR', KEYS[5 + 2 * k]) == joins then
+      redis.call('DEL', KEYS[5 + 2 * k])
+      redis.call('LPUSH', KEYS[4 + 2 * k], ARGV[4])
+    end
+    redis.call('HINCRBY', KEYS[3], ARGV[1] .. '>' .. ARGV[5 + 2 * k], 1)
+  end
+  redis.call('HSET', KEYS[2], 'ts', ARGV[2])
+  redis.call('HINCRBY', KEYS[3], ARGV[1] .. ':count', 1)
+  redis.call('HINCRBYFLOAT', KEYS[3], ARGV[1] .. ':ms', ARGV[3])
+end
+redis.call('RPOP', KEYS[1])
+return completed
+"""
+
+workflow_step_script = redis.register_script(workflow_step_lua)
+
+def complete_workflow_step(queue, table, state, processing, id, r=redis):
+  event = r.hgetall("event_payload:" + id)
+  event['id'] = id
+  # The done marker is set in the same script that removes the event from the
+  # processing list, so an event recovered from the list has never completed the
+  # step and its handler runs again, i.e. handlers are run at least once
+  start = time.time()
+  table[state]['handler'](event, r)
+  elapsed_ms = (time.time() - start) * 1000
+  keys = [processing, "event_payload:" + id, "workflow_stats:" + queue]
+  args = [state, long(time.time()), elapsed_ms, id]
+  for (next_state, joins) in table[state]['next']:
+    keys += ["events:" + queue + ":" + next_state, "join:" + queue + ":" + next_state + ":" + id]
+    args += [next_state, joins]
+  workflow_step_script(keys=keys, args=args, client=r)
+
+def workflow_worker(queue, table, state, worker, stop, max_depth, r):
+  processing = processing_list(queue, state, worker)
+  id = r.lindex(processing, -1)
+  while id != None:
+    complete_workflow_step(queue, table, state, processing, id, r)
+    id = r.lindex(processing, -1)
+  while not stop.is_set():
+    depths = [r.llen("events:" + queue + ":" + n) for (n, _) in table[state]['next'] if n in table]
+    if max_depth != None and len(depths) > 0 and max(depths) >= max_depth:
+      time.sleep(0.1)
+      continue
+    id = r.execute_command("BLMOVE", "events:" + queue + ":" + state, processing, "RIGHT", "LEFT", 1)
+    if id != None:
+      complete_workflow_step(queue, table, state, processing, id, r)
+
+def start_workflow(queue, table, mode="thread", max_depth=1000):
+  # Returns a runner that can be stopped with stop_stages
+  if mode == "thread":
+    stop = threading.Event()
+  else:
+    stop = multiprocessing.Event()
+  workers = []
+  for (state, step) in table.items():
+    r = StrictRedis(connection_pool=ConnectionPool(host=os.environ.get("REDIS_HOST", "localhost"),
+                                                   port=os.environ.get("REDIS_PORT", 6379),
+                                                   db=0))
+    for n in range(step['workers']):
+      args = (queue, table, state, state + "-" + str(n), stop, max_depth, r)
+      if mode == "thread":
+        w = threading.Thread(target=workflow_worker, args=args)
+      else:
+        w = multiprocessing.Process(target=workflow_worker, args=args)
+      w.daemon = True
+      w.start()
+      workers.append(w)
+  return { 'queue': queue, 'stop': stop, 'workers': workers }
+
+def workflow_stats(queue, table, interval=1):
+  # Returns the depth, processing rate (events/sec) and mean handler time of each
+  # state, and the number of events that took each transition
+  before = redis.hgetall("workflow_stats:" + queue)
+  time.sleep(interval)
+  after = redis.hgetall("workflow_stats:" + queue)
+  stats = {}
+  for (state, step) in table.items():
+    count = int(after.get(state + ":count", 0))
+    stats[state] = { 'depth': redis.llen("events:" + queue + ":" + state),
+                     'rate': (count - int(before.get(state + ":count", 0))) / float(interval) if interval > 0 else 0,
+                     'mean_ms': float(after.get(state + ":ms", 0)) / count if count > 0 else 0,
+                     'transitions': dict([(n, int(after.get(state + ">" + n, 0))) for (n, _) in step['next']]) }
+  return stats
+
+def benchmark_workflow(workflow, events):
+  queue = "workflow-" + str(events)
+  table = compile_workflow(workflow, handlers)
+  create_activations(queue, events, 1000)
+  start = time.time()
+  runner = start_workflow(queue, table)
+  while redis.llen("events:" + queue + ":end") < events:
+    print "  {}".format(workflow_stats(queue, table))
+  elapsed = time.time() - start
+  stop_stages(runner)
+  print "workflow events:{} events/sec:{:.1f}".format(events, events / elapsed)
+  print json.dumps(workflow_stats(queue, table, 0), indent=2)
+
+benchmark_workflow(activation_workflow, 10000)
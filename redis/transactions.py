@@ -0,0 +1,32 @@
+# Optimistic transactions, shared by the inventory and state_machines examples
+# fn(p) is called with the keys watched on the pipeline p, so reads made with p
+# are protected by the watch; fn then calls p.multi(), queues the writes and calls
+# p.execute(). If a watched key changes, fn is retried after a random (jittered)
+# backoff that doubles on each attempt. Returns (applied, result of fn)
+from redis import WatchError
+import random
+import threading
+import time
+
+transaction_stats = { 'conflicts': 0, 'retries': 0, 'failures': 0 }
+transaction_stats_lock = threading.Lock()
+
+def count_transaction(stat):
+  with transaction_stats_lock:
+    transaction_stats[stat] += 1
+
+def optimistic_transaction(r, keys, fn, max_retries=10, backoff=0.001):
+  p = r.pipeline()
+  for attempt in range(max_retries + 1):
+    try:
+      p.watch(*keys)
+      return (True, fn(p))
+    except WatchError:
+      count_transaction('conflicts')
+      if attempt < max_retries:
+        count_transaction('retries')
+        time.sleep(random.uniform(0, backoff * 2 ** attempt))
+    finally:
+      p.reset()
+  count_transaction('failures')
+  return (False, None)